@@ -0,0 +1,82 @@
+"""
+Compares computing the building values (upgrade costs and times, capacity, production) using the per-level
+lookup tables of game/buildings.py against computing every value with math.exp, as before the tables were introduced.
+
+Usage: python -m benchmarks.bench_building_tables
+"""
+
+import math
+import os
+import timeit
+from contextlib import ExitStack
+from unittest import mock
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "plemiona_api.settings")
+django.setup()
+
+from game import buildings  # noqa: E402
+from game.models import Village  # noqa: E402
+
+NUMBER = 2000
+
+
+def legacy_get_upgrade_cost(self):
+    return {
+        "wood": round(self.WOOD_COST_FACTOR * math.exp(self.level * buildings.Building.COST_COEFF) / 10) * 10,
+        "clay": round(self.CLAY_COST_FACTOR * math.exp(self.level * buildings.Building.COST_COEFF) / 10) * 10,
+        "iron": round(self.IRON_COST_FACTOR * math.exp(self.level * buildings.Building.COST_COEFF) / 10) * 10,
+    }
+
+
+def legacy_get_upgrade_time(self, town_hall_level):
+    return (
+        self.BASE_UPGRADE_TIME
+        * (self.UPGRADE_TIME_FACTOR**self.level)
+        * (buildings.TownHall.UPGRADE_TIME_DISCOUNT ** (-town_hall_level))
+    ).total_seconds()
+
+
+def legacy_get_capacity(self):
+    return round(self.CAPACITY_COEFF * math.exp(self.level * buildings.Building.COST_COEFF) / 100) * 100
+
+
+def legacy_get_production(self, seconds=1.0):
+    return self.PRODUCTION_FACTOR * math.exp(self.level * self.PRODUCTION_COEFF) / 60 * seconds
+
+
+def compute(village):
+    for building in village.buildings.values():
+        building.get_upgrade_cost()
+        village.get_building_upgrade_time(building)
+
+    village.warehouse.get_capacity()
+    village.sawmill.get_production()
+    village.clay_pit.get_production()
+    village.iron_mine.get_production()
+
+
+def measure(function, village):
+    return min(timeit.repeat(lambda: function(village), number=NUMBER, repeat=5)) / NUMBER
+
+
+def main():
+    village = Village(town_hall_level=7, warehouse_level=9, sawmill_level=12, clay_pit_level=11, iron_mine_level=10)
+    tables = measure(compute, village)
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(buildings.Building, "get_upgrade_cost", legacy_get_upgrade_cost))
+        stack.enter_context(mock.patch.object(buildings.Building, "get_upgrade_time", legacy_get_upgrade_time))
+        stack.enter_context(mock.patch.object(buildings.Warehouse, "get_capacity", legacy_get_capacity))
+        stack.enter_context(mock.patch.object(buildings.ResourceBuilding, "get_production", legacy_get_production))
+        formulas = measure(compute, village)
+
+    print("building values:")
+    print(f"  formulas: {formulas * 1e6:8.1f} us")
+    print(f"  tables:   {tables * 1e6:8.1f} us")
+    print(f"  speedup:  {formulas / tables:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
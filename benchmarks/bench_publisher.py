@@ -0,0 +1,73 @@
+"""
+Compares publishing messages from sync code with async_to_sync(channel_layer.group_send), as
+GameSessionConsumerService._send_message did before, against the persistent notifications.Publisher.
+Reports how many messages per second the caller can publish and how long it takes until all of them are sent.
+
+Usage: python -m benchmarks.bench_publisher [--layer settings] [--messages 2000]
+By default an in-memory channel layer is used, measuring the event loop handoff only. With `--layer settings`
+the configured (Redis) channel layer is used, which also includes the connection reuse.
+"""
+
+import argparse
+import os
+import time
+from unittest import mock
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "plemiona_api.settings")
+django.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.layers import InMemoryChannelLayer, get_channel_layer  # noqa: E402
+
+from game import notifications  # noqa: E402
+
+
+def get_message(index):
+    return {"type": "message", "data": {"message": f"message {index}"}}
+
+
+def send_with_async_to_sync(channel_layer, count):
+    for index in range(count):
+        async_to_sync(channel_layer.group_send)(
+            f"player-{index % 8}", {"type": "send_message", "data": get_message(index)}
+        )
+
+
+def send_with_publisher(publisher, count):
+    for index in range(count):
+        publisher.publish({f"player-{index % 8}": [get_message(index)]})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layer", choices=("memory", "settings"), default="memory")
+    parser.add_argument("--messages", type=int, default=2000)
+    arguments = parser.parse_args()
+
+    count = arguments.messages
+    channel_layer = InMemoryChannelLayer() if arguments.layer == "memory" else get_channel_layer()
+
+    start = time.perf_counter()
+    send_with_async_to_sync(channel_layer, count)
+    async_to_sync_time = time.perf_counter() - start
+
+    with mock.patch.object(notifications, "get_channel_layer", return_value=channel_layer):
+        publisher = notifications.Publisher()
+        publisher.wait_until_sent()  # start the loop thread outside the measurement
+
+        start = time.perf_counter()
+        send_with_publisher(publisher, count)
+        publish_time = time.perf_counter() - start
+        publisher.wait_until_sent()
+        publisher_time = time.perf_counter() - start
+
+    print(f"{count} messages, {arguments.layer} channel layer:")
+    print(f"  async_to_sync:       {count / async_to_sync_time:10.0f} msg/s")
+    print(f"  publisher (caller):  {count / publish_time:10.0f} msg/s")
+    print(f"  publisher (sent):    {count / publisher_time:10.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Counts the statements each game command sends to the database: writes (INSERT, UPDATE, DELETE),
+the columns they write and all queries, transaction control statements excluded.
+Runs against a throwaway test database and a local memory cache, notifications and scheduled events are disabled.
+
+Usage: python -m benchmarks.bench_write_statements
+"""
+
+import os
+from contextlib import ExitStack
+from datetime import timedelta
+from unittest import mock
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "plemiona_api.settings")
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from game import models, scheduler, services, tasks  # noqa: E402
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+TRANSACTION_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+def count_written_columns(sql):
+    if sql.startswith("UPDATE"):
+        return sql.split(" WHERE ", 1)[0].count('" = ')
+    if sql.startswith("INSERT"):
+        return sql.split(")", 1)[0].count(",") + 1
+    return 0
+
+
+def measure(title, command):
+    with CaptureQueriesContext(connection) as context:
+        result = command()
+
+    queries = [query["sql"].lstrip() for query in context.captured_queries]
+    queries = [sql for sql in queries if not sql.upper().startswith(TRANSACTION_STATEMENTS)]
+    writes = [sql for sql in queries if sql.upper().startswith(WRITE_STATEMENTS)]
+    columns = sum(count_written_columns(sql) for sql in writes)
+    print(f"{title:<20} {len(writes):>6} {columns:>8} {len(queries):>8}")
+    return result
+
+
+def run_commands():
+    game_session = models.GameSession.objects.create(owner=None)
+    attacker = services.GameSessionService.join_game_session(game_session, "attacker")
+    defender = services.GameSessionService.join_game_session(game_session, "defender")
+    models.Village.objects.update(wood=900, iron=900, clay=900, spearman_count=50)
+
+    print(f"{'command':<20} {'writes':>6} {'columns':>8} {'queries':>8}")
+    measure("start_game_session", lambda: services.GameSessionService.start_game_session(attacker))
+
+    attacker = models.Player.objects.select_related("game_session", "village").get(id=attacker.id)
+    measure("upgrade_building", lambda: services.VillageService.upgrade_building(attacker, "sawmill"))
+    measure(
+        "train_units",
+        lambda: services.VillageService.train_units(attacker, [{"name": "spearman", "count": 2}]),
+    )
+
+    models.Village.objects.filter(id=defender.village_id).update(spearman_count=0)
+    defender = models.Player.objects.select_related("village").get(id=defender.id)
+    measure(
+        "attack_player",
+        lambda: services.VillageService.attack_player(attacker, defender, [{"name": "spearman", "count": 40}]),
+    )
+
+    battle = models.Battle.objects.get()
+    models.Battle.objects.update(battle_time=timezone.now() + timedelta(seconds=1))
+    measure("attack_task", lambda: tasks.attack_task.run(battle.id))
+    measure("return_units_task", lambda: tasks.return_units_task.run(battle.id))
+    measure("end_game_task", lambda: tasks.end_game_task.run(game_session.id))
+
+
+def main():
+    old_database_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch.object(services.GameSessionConsumerService, "_send_message"))
+            stack.enter_context(mock.patch.object(scheduler, "schedule_event"))
+            stack.enter_context(
+                override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+            )
+            cache.clear()
+            run_commands()
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
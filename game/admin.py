@@ -5,6 +5,18 @@ from game import models
 
 admin.site.register(models.GameSession)
 admin.site.register(models.Task)
-admin.site.register(models.Player)
+admin.site.register(models.ScheduledEvent)
 admin.site.register(models.Village)
 admin.site.register(models.Battle)
+
+
+@admin.register(models.Player)
+class PlayerAdmin(admin.ModelAdmin):
+    list_display = ("nickname", "game_session", "total_points")
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_points()
+
+    @admin.display(ordering="total_points")
+    def total_points(self, player):
+        return player.total_points
@@ -1,6 +1,7 @@
 import math
 from datetime import timedelta
-from typing import ClassVar
+from types import MappingProxyType
+from typing import ClassVar, Mapping
 
 from game import exceptions
 
@@ -21,15 +22,38 @@ class Building:
 
     COST_COEFF: ClassVar[float] = 0.23
 
+    # Lookup tables indexed by level (0...MAX_LEVEL), computed once per class by _build_tables
+    UPGRADE_COSTS: ClassVar[tuple[Mapping[str, int], ...]]
+    UPGRADE_TIMES: ClassVar[tuple[timedelta, ...]]  # without the town hall discount
+
     def __init__(self, level: int = 1) -> None:
         self.level = level
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._build_tables()
+
+    @classmethod
+    def _build_tables(cls) -> None:
+        levels = range(cls.MAX_LEVEL + 1)
+        cls.UPGRADE_COSTS = tuple(
+            MappingProxyType(
+                {
+                    "wood": cls._get_upgrade_cost(cls.WOOD_COST_FACTOR, level),
+                    "clay": cls._get_upgrade_cost(cls.CLAY_COST_FACTOR, level),
+                    "iron": cls._get_upgrade_cost(cls.IRON_COST_FACTOR, level),
+                }
+            )
+            for level in levels
+        )
+        cls.UPGRADE_TIMES = tuple(cls.BASE_UPGRADE_TIME * (cls.UPGRADE_TIME_FACTOR**level) for level in levels)
+
     def get_upgrade_cost(self) -> dict:
-        return {
-            "wood": self._get_upgrade_cost(self.WOOD_COST_FACTOR),
-            "clay": self._get_upgrade_cost(self.CLAY_COST_FACTOR),
-            "iron": self._get_upgrade_cost(self.IRON_COST_FACTOR),
-        }
+        return dict(self.UPGRADE_COSTS[self.level])
+
+    def get_upgrade_time(self, town_hall_level: int) -> float:
+        """Returns the upgrade time in seconds, discounted by the town hall of the given level."""
+        return (self.UPGRADE_TIMES[self.level] * TownHall.UPGRADE_TIME_DISCOUNTS[town_hall_level]).total_seconds()
 
     @property
     def points(self) -> int:
@@ -47,8 +71,12 @@ class Building:
         if self.level > 1:
             self.level -= 1
 
-    def _get_upgrade_cost(self, coeff):
-        return round(coeff * math.exp(self.level * Building.COST_COEFF) / 10) * 10
+    @staticmethod
+    def _get_upgrade_cost(coeff, level):
+        return round(coeff * math.exp(level * Building.COST_COEFF) / 10) * 10
+
+
+Building._build_tables()
 
 
 class TownHall(Building):
@@ -62,6 +90,13 @@ class TownHall(Building):
     # UPGRADE_TIME_DISCOUNT ** (-town_hall.level)
     UPGRADE_TIME_DISCOUNT = 1.05
 
+    UPGRADE_TIME_DISCOUNTS: ClassVar[tuple[float, ...]]
+
+    @classmethod
+    def _build_tables(cls) -> None:
+        super()._build_tables()
+        cls.UPGRADE_TIME_DISCOUNTS = tuple(cls.UPGRADE_TIME_DISCOUNT ** (-level) for level in range(cls.MAX_LEVEL + 1))
+
 
 class Warehouse(Building):
     POINTS_PER_LEVEL = 30
@@ -74,8 +109,18 @@ class Warehouse(Building):
     # Capacity coefficient
     CAPACITY_COEFF: ClassVar[float] = 813
 
+    CAPACITIES: ClassVar[tuple[int, ...]]
+
+    @classmethod
+    def _build_tables(cls) -> None:
+        super()._build_tables()
+        cls.CAPACITIES = tuple(
+            round(cls.CAPACITY_COEFF * math.exp(level * Building.COST_COEFF) / 100) * 100
+            for level in range(cls.MAX_LEVEL + 1)
+        )
+
     def get_capacity(self) -> int:
-        return round(self.CAPACITY_COEFF * math.exp(self.level * Building.COST_COEFF) / 100) * 100
+        return self.CAPACITIES[self.level]
 
 
 class Barracks(Building):
@@ -94,9 +139,18 @@ class ResourceBuilding(Building):
     PRODUCTION_FACTOR: ClassVar[float] = 51.614  # per minute
     PRODUCTION_COEFF: ClassVar[float] = 0.15
 
-    def get_production(self, seconds: float = 1.0) -> float:
+    PRODUCTIONS: ClassVar[tuple[float, ...]]  # per second
+
+    @classmethod
+    def _build_tables(cls) -> None:
+        super()._build_tables()
         # (PRODUCTION_FACTOR * math.exp(level * PRODUCTION_COEFF) / 60) -> per second
-        return self.PRODUCTION_FACTOR * math.exp(self.level * self.PRODUCTION_COEFF) / 60 * seconds
+        cls.PRODUCTIONS = tuple(
+            cls.PRODUCTION_FACTOR * math.exp(level * cls.PRODUCTION_COEFF) / 60 for level in range(cls.MAX_LEVEL + 1)
+        )
+
+    def get_production(self, seconds: float = 1.0) -> float:
+        return self.PRODUCTIONS[self.level] * seconds
 
 
 class IronMine(ResourceBuilding):
@@ -0,0 +1,79 @@
+"""
+Combat math of a battle, free of the ORM, notifications and scheduling.
+
+Unit counts are tuples ordered like Village.UNIT_NAMES, resources tuples ordered like Village.RESOURCE_NAMES:
+    resolve_battle(attacker_counts=(40, 0, 10, 0), defender_counts=(5, 5, 0, 0), defender_resources=(900, 500, 700))
+resolve_battles resolves a whole batch, BattleService.battle_phase applies the outcome to the Battle and the village.
+"""
+
+from typing import Iterable, NamedTuple
+
+from game import units
+from game.models import Battle, Village
+
+UNIT_CLASSES = tuple(units.UNITS[unit_name] for unit_name in Village.UNIT_NAMES)
+OFFENSIVE_STRENGTHS = tuple(unit_class.OFFENSIVE_STRENGTH for unit_class in UNIT_CLASSES)
+DEFENSIVE_STRENGTHS = tuple(unit_class.DEFENSIVE_STRENGTH for unit_class in UNIT_CLASSES)
+CARRYING_CAPACITIES = tuple(unit_class.CARRYING_CAPACITY for unit_class in UNIT_CLASSES)
+
+NO_UNITS = (0,) * len(UNIT_CLASSES)
+NO_RESOURCES = (0,) * len(Village.RESOURCE_NAMES)
+
+
+class BattleOutcome(NamedTuple):
+    is_attacker_winner: bool
+    attacker_strength: float
+    defender_strength: float
+    left_attacker_counts: tuple[int, ...]
+    left_defender_counts: tuple[int, ...]
+    attacker_lost_morale: float
+    defender_lost_morale: float
+    plundered_resources: tuple[float, ...]
+
+
+def dot(counts: Iterable[int], values: Iterable[int]) -> int:
+    return sum(count * value for count, value in zip(counts, values))
+
+
+def resolve_battle(
+    attacker_counts: tuple[int, ...], defender_counts: tuple[int, ...], defender_resources: tuple[float, ...]
+) -> BattleOutcome:
+    attacker_strength = dot(attacker_counts, OFFENSIVE_STRENGTHS)
+    defender_strength = (1 + dot(defender_counts, DEFENSIVE_STRENGTHS)) * Village.DEFENSIVE_BONUS
+
+    # The loser loses all units, the winner the share of the weaker side's strength
+    ratio = min(attacker_strength, defender_strength) / max(attacker_strength, defender_strength)
+
+    if attacker_strength > defender_strength:
+        left_attacker_counts = tuple(round(count * (1 - ratio)) for count in attacker_counts)
+        # Every resource is plundered up to the capacity of the surviving units
+        capacity = dot(left_attacker_counts, CARRYING_CAPACITIES)
+
+        return BattleOutcome(
+            is_attacker_winner=True,
+            attacker_strength=attacker_strength,
+            defender_strength=defender_strength,
+            left_attacker_counts=left_attacker_counts,
+            left_defender_counts=NO_UNITS,
+            attacker_lost_morale=Battle.BASE_MORALE_LOSS * ratio * 0.5,
+            defender_lost_morale=Battle.BASE_MORALE_LOSS * (1 - ratio),
+            plundered_resources=tuple(min(amount, capacity) for amount in defender_resources),
+        )
+
+    return BattleOutcome(
+        is_attacker_winner=False,
+        attacker_strength=attacker_strength,
+        defender_strength=defender_strength,
+        left_attacker_counts=NO_UNITS,
+        left_defender_counts=tuple(round(count * (1 - ratio)) for count in defender_counts),
+        attacker_lost_morale=Battle.BASE_MORALE_LOSS * (1 - ratio),
+        defender_lost_morale=0,
+        plundered_resources=NO_RESOURCES,
+    )
+
+
+def resolve_battles(
+    battles: Iterable[tuple[tuple[int, ...], tuple[int, ...], tuple[float, ...]]],
+) -> list[BattleOutcome]:
+    """Resolves a batch of (attacker_counts, defender_counts, defender_resources) battles."""
+    return [resolve_battle(*battle) for battle in battles]
@@ -1,43 +1,63 @@
+from datetime import datetime
 from typing import Optional
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.utils import timezone
+from rest_framework.exceptions import APIException
 
-from game import models, serializers
+from game import models, serializers, services
+from game.deltas import DeltaStream
+from utils.jwt_authentication import get_session_claims
 
 
 class GameSessionConsumer(AsyncJsonWebsocketConsumer):
+    # Messages holding a part of the player's state, sent to the client as deltas (see game/deltas.py)
+    DELTA_STREAMS = ("fetch_resources", "fetch_buildings", "fetch_units")
+
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
+        self.delta_streams = {message_type: DeltaStream(message_type) for message_type in self.DELTA_STREAMS}
         self.room_group_name: Optional[str] = None
         self.player: Optional[models.Player] = None
+        self.player_id: Optional[str] = None
         self.player_channel_name: Optional[str] = None
+        # Loaded once on connect, then kept up to date by the start_game_session and fetch_leaderboard messages
         self.has_game_session_started: bool = False
-        self.has_game_session_ended: bool = False
+        self.game_session_ended_at: Optional[datetime] = None
+
+    @property
+    def has_game_session_ended(self) -> bool:
+        return self.game_session_ended_at is not None and timezone.now() >= self.game_session_ended_at
 
     async def connect(self):
-        self.player = self.scope.get("player", None)
-        if not self.player:
+        # Claims of the session token (see JwtAuthMiddleware), or those of a player authenticated with an older token
+        session_claims = self.scope.get("session_claims", None)
+        if session_claims is None and self.scope.get("player", None):
+            session_claims = get_session_claims(self.scope["player"])
+
+        if not session_claims:
             await self.close()
             return
 
-        self.has_game_session_started = await self.get_has_game_session_started()
+        self.player_id = session_claims["player_id"]
+        self.room_group_name = str(session_claims["game_code"])
+        self.player_channel_name = str(session_claims["channel_name"])
 
-        if self.has_game_session_started:
-            self.has_game_session_ended = await self.get_has_game_session_ended()
+        # Joined before the state is loaded, so that no message sent in between is missed
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_add(self.player_channel_name, self.channel_name)
 
-        if self.has_game_session_ended:
+        state = await self.load_connection_state()
+
+        if self.player is None or self.has_game_session_ended:
+            await self.disconnect(None)
             await self.close()
             return
 
-        self.room_group_name = await self.get_room_group_name()
-        self.player_channel_name = str(self.player.channel_name)
-
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.channel_layer.group_add(self.player_channel_name, self.channel_name)
         await self.accept()
 
-        await self._send_message_on_connect()
+        await self._send_message_on_connect(state)
 
     async def disconnect(self, close_code):
         if not (self.room_group_name or self.player_channel_name):
@@ -52,33 +72,45 @@ class GameSessionConsumer(AsyncJsonWebsocketConsumer):
         if not self.player:
             return
 
-        await self.player.arefresh_from_db()
-
-        if not self.has_game_session_started:
-            self.has_game_session_started = await self.get_has_game_session_started()
-
-            if not self.has_game_session_started:
-                return
+        if command_type == "ack":
+            stream = self.delta_streams.get(content.get("stream"))
+            if stream and isinstance(content.get("version"), int):
+                stream.acknowledge(content["version"])
+            return
 
-        if not self.has_game_session_ended:
-            self.has_game_session_ended = await self.get_has_game_session_ended()
+        if command_type == "resync":
+            for stream in self.delta_streams.values():
+                if stream.state is not None:
+                    await self.send_json(stream.encode({}, full=True))
+            return
 
-        if self.has_game_session_ended:
+        if not self.has_game_session_started or self.has_game_session_ended:
             return
 
         if command_type == "fetch_resources":
-            await self.send_json(
+            await self.send_state(
                 {
                     "type": "fetch_resources",
-                    "data": await self.update_resources(),
-                }
+                    "data": await self.get_resources(),
+                },
+                full=True,
             )
 
         elif command_type == "fetch_buildings":
-            await self.send_json(
+            await self.send_state(
                 {
                     "type": "fetch_buildings",
                     "data": await self.get_village(),
+                },
+                full=True,
+            )
+
+        elif command_type == "preview_attack":
+            # {"type": "preview_attack", "defenderId": 2, "units": [{"name": "axeman", "count": 30}]}
+            await self.send_json(
+                {
+                    "type": "preview_attack",
+                    "data": await self.preview_attack(content),
                 }
             )
 
@@ -92,33 +124,75 @@ class GameSessionConsumer(AsyncJsonWebsocketConsumer):
 
     async def send_message(self, event):
         # Should be called by group_send only
-        await self.send_json(event["data"])
-
-    async def _send_message_on_connect(self):
+        self.update_game_session_state(event["data"])
+        await self.send_state(event["data"])
+
+    def update_game_session_state(self, message):
+        if message["type"] == "start_game_session":
+            self.has_game_session_started = True
+            self.game_session_ended_at = datetime.fromisoformat(message["data"]["endedAt"])
+
+        elif message["type"] == "fetch_leaderboard":
+            # The leaderboard is sent once the game session has ended
+            if not self.has_game_session_ended:
+                self.game_session_ended_at = timezone.now()
+
+    async def send_messages(self, event):
+        # Should be called by group_send only, with the messages of a notification batch (see game/notifications.py)
+        encoded_messages = []
+        for message in event["data"]:
+            self.update_game_session_state(message)
+            encoded_message = self.encode_state(message)
+            if encoded_message:
+                encoded_messages.append(encoded_message)
+
+        if len(encoded_messages) > 1:
+            await self.send_json({"type": "batch", "data": encoded_messages})
+        elif encoded_messages:
+            await self.send_json(encoded_messages[0])
+
+    async def send_state(self, message, full=False):
+        encoded_message = self.encode_state(message, full=full)
+        if encoded_message:
+            await self.send_json(encoded_message)
+
+    def encode_state(self, message, full=False):
+        """Returns the message as sent to the client, a delta for the DELTA_STREAMS or None if nothing changed."""
+        stream = self.delta_streams.get(message["type"])
+        if stream is None:
+            return message
+
+        return stream.encode(message["data"], full=full)
+
+    async def _send_message_on_connect(self, state):
         if self.has_game_session_started:
+            for message_type in self.DELTA_STREAMS:
+                self.delta_streams[message_type].encode(state[message_type], full=True)
+
             await self.send_json(
                 {
                     "type": "fetch_game_session_state",
                     "data": {
-                        "players": await self.get_players_in_game(),
-                        "owner": await self.get_owner(),
-                        "endedAt": await self.get_game_session_ended_at(),
-                        "battleLog": await self.get_battle_log(),
-                        **await self.get_village(),
-                        **await self.update_resources(),
-                        **await self.get_units(),
+                        "players": state["players"],
+                        "owner": state["owner"],
+                        "endedAt": self.game_session_ended_at.isoformat(),
+                        "gameDataVersion": services.GameDataService.get_game_data()["version"],
+                        "versions": {
+                            message_type: stream.version for message_type, stream in self.delta_streams.items()
+                        },
+                        **state["battle_log"],
+                        **state["fetch_buildings"],
+                        **state["fetch_resources"],
+                        **state["fetch_units"],
                     },
                 }
             )
         else:
-            players = await self.get_players_in_lobby()
-            owner = await self.get_owner()
-
             data = {
                 "type": "players_list",
                 "data": {
-                    "owner": owner,
-                    "players": players,
+                    "owner": state["owner"],
+                    "players": state["players"],
                 },
             }
 
@@ -131,47 +205,86 @@ class GameSessionConsumer(AsyncJsonWebsocketConsumer):
             )
 
     @database_sync_to_async
-    def get_room_group_name(self):
-        return str(self.player.game_session.game_code)
+    def load_connection_state(self) -> Optional[dict]:
+        """
+        Loads the player with the village and game session, the roster and the battle log (cached, see
+        BattleLogService) in one thread hop, and returns the data sent on connect.
+        Returns None if the player no longer exists or the game session has ended.
+        """
+        self.player = (
+            models.Player.objects.select_related("village", "game_session__owner").filter(id=self.player_id).first()
+        )
+        if self.player is None:
+            return None
+
+        game_session = self.player.game_session
+        self.has_game_session_started = game_session.has_started
+        self.game_session_ended_at = game_session.ended_at
 
-    @database_sync_to_async
-    def get_players_in_lobby(self):
-        return serializers.PlayerInLobbySerializer(self.player.game_session.player_set.all(), many=True).data
+        if self.has_game_session_ended:
+            return None
 
-    @database_sync_to_async
-    def get_owner(self):
-        return serializers.PlayerInLobbySerializer(self.player.game_session.owner).data
+        owner = serializers.PlayerInLobbySerializer(game_session.owner).data
+        if not self.has_game_session_started:
+            players = game_session.player_set.all()
+            return {"owner": owner, "players": serializers.PlayerInLobbySerializer(players, many=True).data}
+
+        players = game_session.player_set.select_related("village")
+        village = self.player.village
+        village.update_resources(commit=False)
+        village.update_units(commit=False)
+
+        return {
+            "owner": owner,
+            "players": serializers.PlayerDataSerializer(players, many=True).data,
+            "battle_log": {"battleLog": services.BattleLogService.get_battle_log(game_session)},
+            "fetch_buildings": serializers.VillageSerializer(village).data,
+            "fetch_resources": serializers.ResourcesSerializer(village).data,
+            "fetch_units": serializers.UnitsCountInVillageSerializer(village).data,
+        }
+
+    def _reload_village(self):
+        # The village is the only state commands read, it is changed by requests handled elsewhere
+        self.player.village = models.Village.objects.get(id=self.player.village_id)
 
     @database_sync_to_async
-    def update_resources(self):
-        self.player.village.update_resources()
+    def get_resources(self):
+        self._reload_village()
+        self.player.village.update_resources(commit=False)
         return serializers.ResourcesSerializer(self.player.village).data
 
     @database_sync_to_async
     def get_village(self):
+        self._reload_village()
+        self.player.village.update_resources(commit=False)
         return serializers.VillageSerializer(self.player.village).data
 
     @database_sync_to_async
-    def get_has_game_session_started(self):
-        return self.player.game_session.has_started
+    def preview_attack(self, content):
+        """Returns the preview of VillageService.preview_attack, or {"errors": {...}} if the attack is not possible."""
+        serializer = serializers.UnitsSerializer(data=content)
+        if not serializer.is_valid():
+            return {"errors": serializer.errors}
+
+        defender_id = content.get("defenderId")
+        defender = None
+        if isinstance(defender_id, int):
+            defender = (
+                models.Player.objects.select_related("village")
+                .filter(id=defender_id, game_session_id=self.player.game_session_id)
+                .first()
+            )
 
-    @database_sync_to_async
-    def get_game_session_ended_at(self):
-        return self.player.game_session.ended_at.isoformat()
+        if defender is None:
+            return {"errors": {"Player": ["Player not found."]}}
 
-    @database_sync_to_async
-    def get_has_game_session_ended(self):
-        return self.player.game_session.has_ended
+        self._reload_village()
+        try:
+            return services.VillageService.preview_attack(self.player, defender, serializer.validated_data["units"])
+        except APIException as error:
+            return {"errors": error.detail}
 
     @database_sync_to_async
     def get_players_in_game(self):
-        return serializers.PlayerDataSerializer(self.player.game_session.player_set.all(), many=True).data
-
-    @database_sync_to_async
-    def get_units(self):
-        return serializers.UnitsInVillageSerializer(self.player.village).data
-
-    @database_sync_to_async
-    def get_battle_log(self):
-        battles = self.player.game_session.battles.order_by("-start_time")[:10]
-        return serializers.BattleLogSerializer(battles, many=True).data
+        players = self.player.game_session.player_set.select_related("village")
+        return serializers.PlayerDataSerializer(players, many=True).data
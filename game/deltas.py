@@ -0,0 +1,92 @@
+"""
+Delta encoding of the state pushed to a websocket client.
+
+Every stream (fetch_resources, fetch_buildings, ...) is versioned per connection. As long as the client has not
+acknowledged any version (`{"type": "ack", "stream": "fetch_buildings", "version": 3}`) it receives full snapshots:
+    {"type": "fetch_buildings", "version": 3, "data": {...}}
+Afterwards only the fields changed since the last acknowledged version are sent, nested dicts are diffed
+key by key, anything else (lists included) is sent whole and removed keys are sent as null:
+    {"type": "fetch_buildings_delta", "version": 4, "baseVersion": 3, "data": {"buildings": {"sawmill": {...}}}}
+A full snapshot is sent again every FULL_SYNC_INTERVAL messages, or when the client sends `{"type": "resync"}`.
+"""
+
+from collections import OrderedDict
+from typing import Optional
+
+
+def merge(state: dict, patch: dict) -> dict:
+    """Returns the state with the patch applied, nested dicts are merged instead of replaced."""
+    merged = dict(state)
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+
+    return merged
+
+
+def diff(old: dict, new: dict) -> dict:
+    """Returns the patch turning old into new, the inverse of merge."""
+    patch = {key: None for key in old.keys() - new.keys()}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested_patch = diff(old[key], value)
+            if nested_patch:
+                patch[key] = nested_patch
+        elif value != old[key]:
+            patch[key] = value
+
+    return patch
+
+
+class DeltaStream:
+    FULL_SYNC_INTERVAL = 50
+    HISTORY_SIZE = 16
+
+    def __init__(self, message_type: str) -> None:
+        self.message_type = message_type
+        self.version = 0
+        self.state: Optional[dict] = None
+        self.acknowledged_version: Optional[int] = None
+        self.deltas_since_full_sync = 0
+        self._history: OrderedDict[int, dict] = OrderedDict()
+
+    def encode(self, data: dict, full: bool = False) -> Optional[dict]:
+        """
+        Applies the data (a complete or partial snapshot) to the stream and returns the message for the client,
+        or None if nothing has changed and a full snapshot was not requested.
+        """
+        state = data if self.state is None else merge(self.state, data)
+        if state == self.state and not full:
+            return None
+
+        if state != self.state:
+            self.version += 1
+            self.state = state
+            self._history[self.version] = state
+            while len(self._history) > self.HISTORY_SIZE:
+                self._history.popitem(last=False)
+
+        base_state = self._history.get(self.acknowledged_version)
+        if full or base_state is None or self.deltas_since_full_sync >= self.FULL_SYNC_INTERVAL:
+            self.deltas_since_full_sync = 0
+            return {"type": self.message_type, "version": self.version, "data": state}
+
+        self.deltas_since_full_sync += 1
+        return {
+            "type": f"{self.message_type}_delta",
+            "version": self.version,
+            "baseVersion": self.acknowledged_version,
+            "data": diff(base_state, state),
+        }
+
+    def acknowledge(self, version: int) -> None:
+        if version not in self._history:
+            return
+
+        self.acknowledged_version = version
+        for older_version in [v for v in self._history if v < version]:
+            del self._history[older_version]
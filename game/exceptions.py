@@ -51,6 +51,11 @@ class InsufficientResourcesException(APIException):
     default_detail = {"Resources": ["You do not have enough resources."]}
 
 
+class ResourcesConflictException(APIException):
+    status_code = 409
+    default_detail = {"Resources": ["Your resources have changed in the meantime, please try again."]}
+
+
 class BuildingMaxLevelException(APIException):
     status_code = 400
     default_detail = {"Building level": ["This building has already reached maximum level."]}
@@ -81,11 +86,6 @@ class CannotAttackYourselfException(APIException):
     default_detail = {"Attack": ["You cannot attack yourself."]}
 
 
-class UnitsAreAlreadyBeingTrainedException(APIException):
-    status_code = 400
-    default_detail = {"Units": ["Units are already being trained."]}
-
-
 class InsufficientUnitsException(APIException):
     status_code = 400
     default_detail = {"Units": ["You do not have enough units."]}
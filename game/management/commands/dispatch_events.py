@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from game.scheduler import DatabaseScheduler
+
+
+class Command(BaseCommand):
+    help = "Runs the delayed game events stored by game.scheduler.DatabaseScheduler as they become due."
+
+    def handle(self, *args, **options):
+        self.stdout.write("Dispatching game events...")
+        DatabaseScheduler().run_forever()
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0025_battle_phase_battle_result_alter_battle_game_session"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="village",
+            name="training_queue",
+            field=models.JSONField(default=list),
+        ),
+    ]
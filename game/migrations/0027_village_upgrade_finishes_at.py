@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0026_village_training_queue"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="village",
+            name="is_barracks_upgrading",
+        ),
+        migrations.RemoveField(
+            model_name="village",
+            name="is_clay_pit_upgrading",
+        ),
+        migrations.RemoveField(
+            model_name="village",
+            name="is_iron_mine_upgrading",
+        ),
+        migrations.RemoveField(
+            model_name="village",
+            name="is_sawmill_upgrading",
+        ),
+        migrations.RemoveField(
+            model_name="village",
+            name="is_town_hall_upgrading",
+        ),
+        migrations.RemoveField(
+            model_name="village",
+            name="is_warehouse_upgrading",
+        ),
+        migrations.AddField(
+            model_name="village",
+            name="barracks_upgrade_finishes_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="village",
+            name="clay_pit_upgrade_finishes_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="village",
+            name="iron_mine_upgrade_finishes_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="village",
+            name="sawmill_upgrade_finishes_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="village",
+            name="town_hall_upgrade_finishes_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="village",
+            name="warehouse_upgrade_finishes_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
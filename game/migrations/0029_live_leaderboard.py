@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0028_scheduledevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gamesession",
+            name="is_leaderboard_dirty",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="village",
+            name="points",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0029_live_leaderboard"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="battle",
+            index=models.Index(fields=["game_session", "-start_time"], name="battle_log_idx"),
+        ),
+    ]
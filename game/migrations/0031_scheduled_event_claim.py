@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0030_battle_log_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scheduledevent",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="scheduledevent",
+            name="started_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0031_scheduled_event_claim"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="village",
+            name="are_units_training",
+        ),
+    ]
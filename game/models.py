@@ -1,13 +1,16 @@
+import math
 import uuid
 import random
 import string
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least
 from django.utils import timezone
 
 from game import exceptions, units
-from game.buildings import Building, TownHall, Warehouse, IronMine, ClayPit, Sawmill, Barracks
+from game.buildings import BUILDINGS, Building, TownHall, Warehouse, IronMine, ClayPit, Sawmill, Barracks
 from utils.models import BaseModel
 
 
@@ -21,6 +24,8 @@ class GameSession(BaseModel):
     game_code = models.CharField(max_length=GAME_CODE_LENGTH, null=False, unique=True, editable=False, db_index=True)
     has_started = models.BooleanField(default=False, null=False)
     ended_at = models.DateTimeField(null=True, default=None)
+    # Set when points changed since the last live leaderboard broadcast, see LeaderboardService
+    is_leaderboard_dirty = models.BooleanField(default=False, null=False)
 
     @property
     def has_ended(self):
@@ -51,6 +56,33 @@ class Task(BaseModel):
         return str(self.task_id)
 
 
+class ScheduledEvent(BaseModel):
+    """Delayed game event waiting for the dispatcher of game.scheduler.DatabaseScheduler."""
+
+    name = models.CharField(max_length=32, null=False)
+    args = models.JSONField(default=list, null=False)
+    eta = models.DateTimeField(null=False, db_index=True)
+    # Set when a dispatcher claims the event, the row is deleted once the handler has run
+    started_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0, null=False)
+
+    def __str__(self):
+        return f"{self.name}{tuple(self.args)} at {self.eta}"
+
+
+class PlayerQuerySet(models.QuerySet):
+    def with_points(self):
+        """Annotates total_points, the value of Player.points computed by the database."""
+        return self.annotate(total_points=Village.get_points_expression("village__"))
+
+    def leaderboard(self):
+        return self.with_points().order_by("-total_points", "id")
+
+    def live_leaderboard(self):
+        """Orders by the points maintained during the game, settled only when they change."""
+        return self.annotate(total_points=F("village__points")).order_by("-total_points", "id")
+
+
 class Player(BaseModel):
     NICKNAME_MIN_LENGTH = 3
     NICKNAME_MAX_LENGTH = 15
@@ -63,6 +95,8 @@ class Player(BaseModel):
 
     is_authenticated = True
 
+    objects = PlayerQuerySet.as_manager()
+
     class Meta:
         unique_together = ("game_session", "nickname")
 
@@ -88,8 +122,21 @@ class Village(BaseModel):
     DEFENSIVE_BONUS = 1.2
     BUILDING_NAMES = ("town_hall", "warehouse", "iron_mine", "clay_pit", "sawmill", "barracks")
     UNIT_NAMES = ("spearman", "swordsman", "axeman", "archer")
+    UNIT_COUNT_FIELDS = tuple(f"{unit_name}_count" for unit_name in UNIT_NAMES)
+    RESOURCE_NAMES = ("wood", "iron", "clay")
+
+    # Fields the resources are settled from, see _change_resources
+    SETTLED_FIELDS = (
+        *RESOURCE_NAMES,
+        "last_resources_update",
+        *(f"{building_name}_level" for building_name in BUILDING_NAMES),
+        *(f"{building_name}_upgrade_finishes_at" for building_name in BUILDING_NAMES),
+    )
+    CHANGE_RESOURCES_ATTEMPTS = 3
 
     morale = models.IntegerField(default=MAX_MORALE, null=False)
+    # Player.points as of the last change, for the live leaderboard
+    points = models.IntegerField(default=0, null=False)
 
     # Coordinates
     x = models.IntegerField(default=0, null=False)
@@ -114,13 +161,13 @@ class Village(BaseModel):
     sawmill_level = models.IntegerField(default=1, null=False)
     barracks_level = models.IntegerField(default=1, null=False)
 
-    # Upgrading status
-    is_town_hall_upgrading = models.BooleanField(default=False, null=False)
-    is_warehouse_upgrading = models.BooleanField(default=False, null=False)
-    is_iron_mine_upgrading = models.BooleanField(default=False, null=False)
-    is_clay_pit_upgrading = models.BooleanField(default=False, null=False)
-    is_sawmill_upgrading = models.BooleanField(default=False, null=False)
-    is_barracks_upgrading = models.BooleanField(default=False, null=False)
+    # Time at which the ongoing upgrade finishes, None if the building is not being upgraded
+    town_hall_upgrade_finishes_at = models.DateTimeField(null=True, default=None)
+    warehouse_upgrade_finishes_at = models.DateTimeField(null=True, default=None)
+    iron_mine_upgrade_finishes_at = models.DateTimeField(null=True, default=None)
+    clay_pit_upgrade_finishes_at = models.DateTimeField(null=True, default=None)
+    sawmill_upgrade_finishes_at = models.DateTimeField(null=True, default=None)
+    barracks_upgrade_finishes_at = models.DateTimeField(null=True, default=None)
 
     # Units in the barracks
     spearman_count = models.IntegerField(default=0, null=False)
@@ -128,7 +175,8 @@ class Village(BaseModel):
     axeman_count = models.IntegerField(default=0, null=False)
     archer_count = models.IntegerField(default=0, null=False)
 
-    are_units_training = models.BooleanField(default=False, null=False)
+    # Batches of units waiting in the barracks, trained one after another
+    training_queue = models.JSONField(default=list, null=False)
 
     @property
     def spearman(self):
@@ -155,6 +203,16 @@ class Village(BaseModel):
             "archer": self.archer,
         }
 
+    @property
+    def training_finishes_at(self):
+        if not self.training_queue:
+            return None
+
+        last_batch = self.training_queue[-1]
+        return datetime.fromisoformat(last_batch["startedAt"]) + timedelta(
+            seconds=last_batch["trainingTime"] * last_batch["count"]
+        )
+
     @property
     def town_hall(self):
         return TownHall(level=self.town_hall_level)
@@ -190,55 +248,242 @@ class Village(BaseModel):
             "barracks": self.barracks,
         }
 
+    @property
+    def buildings_upgrade_finishes_at(self):
+        return {
+            "town_hall": self.town_hall_upgrade_finishes_at,
+            "warehouse": self.warehouse_upgrade_finishes_at,
+            "iron_mine": self.iron_mine_upgrade_finishes_at,
+            "clay_pit": self.clay_pit_upgrade_finishes_at,
+            "sawmill": self.sawmill_upgrade_finishes_at,
+            "barracks": self.barracks_upgrade_finishes_at,
+        }
+
     @property
     def buildings_upgrading_state(self):
         return {
-            "town_hall": self.is_town_hall_upgrading,
-            "warehouse": self.is_warehouse_upgrading,
-            "iron_mine": self.is_iron_mine_upgrading,
-            "clay_pit": self.is_clay_pit_upgrading,
-            "sawmill": self.is_sawmill_upgrading,
-            "barracks": self.is_barracks_upgrading,
+            building_name: finishes_at is not None
+            for building_name, finishes_at in self.buildings_upgrade_finishes_at.items()
         }
 
-    def update_resources(self):
-        if not self.last_resources_update:
-            self.last_resources_update = timezone.now()
-            self.save()
-            return
+    @classmethod
+    def get_points_expression(cls, prefix=""):
+        """Player.points of the village as a database expression, prefix is the lookup path to the village."""
+        building_points = [
+            F(f"{prefix}{building_name}_level") * BUILDINGS[building_name].POINTS_PER_LEVEL
+            for building_name in cls.BUILDING_NAMES
+        ]
+        unit_points = [
+            F(f"{prefix}{unit_name}_count") * units.UNITS[unit_name].POINTS_PER_UNIT for unit_name in cls.UNIT_NAMES
+        ]
+        return sum(building_points + unit_points, F(f"{prefix}morale"))
+
+    def update_resources(self, commit=True):
+        """
+        Settles the village up to now: credits the resources produced since the last update
+        and applies the building upgrades which have finished in the meantime.
+        With commit=False the settlement is not a change of its own, see get_dirty_fields.
+        """
+        self._settle_resources(timezone.now())
+
+        if commit:
+            self.save(update_fields=[*self.SETTLED_FIELDS, "updated_at"])
+
+    def get_dirty_fields(self) -> list[str]:
+        """
+        Settling the resources in memory does not make them dirty, the stored state projects to the same values.
+        Saving them could overwrite a concurrent charge_resources, so they are only saved if changed otherwise.
+        """
+        dirty_fields = super().get_dirty_fields()
+        dirty_settled_fields = [field for field in dirty_fields if field in self.SETTLED_FIELDS]
+        if not dirty_settled_fields or self.last_resources_update is None:
+            return dirty_fields
+
+        stored_village = self._get_stored_village()
+        stored_village._settle_resources(self.last_resources_update)
+        for field in dirty_settled_fields:
+            stored_value, value = getattr(stored_village, field), getattr(self, field)
+            # Settling twice in a row splits the production differently, up to rounding errors
+            if field in self.RESOURCE_NAMES and math.isclose(stored_value, value, abs_tol=1e-6):
+                continue
+            if stored_value != value:
+                return dirty_fields
+
+        return [field for field in dirty_fields if field not in self.SETTLED_FIELDS]
+
+    def project_resources(self, at=None) -> dict[str, float]:
+        """
+        Returns the resources the village has at the given instant (now by default),
+        including the production changes of the upgrades finished in the meantime. The village is left untouched.
+        """
+        resources = {"wood": self.wood, "iron": self.iron, "clay": self.clay}
+
+        for seconds_passed, levels in self._get_production_periods(at or timezone.now()):
+            warehouse_capacity = Warehouse.CAPACITIES[levels["warehouse"]]
+            production = self._get_production(levels)
+            resources = {
+                resource_name: min(amount + production[resource_name] * seconds_passed, warehouse_capacity)
+                for resource_name, amount in resources.items()
+            }
+
+        return resources
+
+    def get_finished_upgrades(self, now) -> list[tuple[datetime, str]]:
+        return sorted(
+            (finishes_at, building_name)
+            for building_name, finishes_at in self.buildings_upgrade_finishes_at.items()
+            if finishes_at is not None and finishes_at <= now
+        )
 
-        seconds_passed = (timezone.now() - self.last_resources_update).total_seconds()
+    def charge_resources(self, resources):
+        """
+        Settles the production and deducts the resources in a single conditional UPDATE,
+        so concurrent charges and additions of the same village cannot overwrite each other.
+        Raises InsufficientResourcesException if the village cannot afford it.
+        """
+        self._change_resources(resources, "charge")
 
-        self.wood += self.sawmill.get_production(seconds_passed)
-        self.iron += self.iron_mine.get_production(seconds_passed)
-        self.clay += self.clay_pit.get_production(seconds_passed)
+    def add_resources(self, resources):
+        """Settles the production and adds the resources, capped by the warehouse, in a single UPDATE."""
+        self._change_resources(resources, "add")
 
-        warehouse_capacity = self.warehouse.get_capacity()
-        self.wood = min(self.wood, warehouse_capacity)
-        self.iron = min(self.iron, warehouse_capacity)
-        self.clay = min(self.clay, warehouse_capacity)
+    def plunder_resources(self, resources) -> dict[str, float]:
+        """
+        Settles the production and deducts the resources, down to what the village has left, in a single UPDATE.
+        Returns the resources actually taken, which are less than asked for if the village has spent them meanwhile.
+        """
+        return self._change_resources(resources, "plunder")
 
-        self.last_resources_update = timezone.now()
-        self.save()
+    def _settle_resources(self, now):
+        resources = self.project_resources(now)
 
-    def charge_resources(self, resources):
-        if self.wood < resources["wood"] or self.iron < resources["iron"] or self.clay < resources["clay"]:
-            raise exceptions.InsufficientResourcesException
+        for _, building_name in self.get_finished_upgrades(now):
+            self.upgrade_building_level(building_name, commit=False)
+            self.set_building_upgrade_finishes_at(building_name, None, commit=False)
 
-        self.wood -= resources["wood"]
-        self.iron -= resources["iron"]
-        self.clay -= resources["clay"]
+        self.wood, self.iron, self.clay = resources["wood"], resources["iron"], resources["clay"]
+        self.last_resources_update = now
 
-        self.save()
+    def _get_production_periods(self, at) -> list[tuple[float, dict[str, int]]]:
+        """Splits the time between the last update and the given instant into periods of constant production."""
+        if not self.last_resources_update:
+            # Resources are not gathered until the game session starts
+            return []
+
+        levels = {
+            "warehouse": self.warehouse_level,
+            "iron_mine": self.iron_mine_level,
+            "clay_pit": self.clay_pit_level,
+            "sawmill": self.sawmill_level,
+        }
+        periods = []
+        produced_since = self.last_resources_update
 
-    def add_resources(self, resources):
-        self.wood = min(self.wood + resources["wood"], self.warehouse.get_capacity())
-        self.iron = min(self.iron + resources["iron"], self.warehouse.get_capacity())
-        self.clay = min(self.clay + resources["clay"], self.warehouse.get_capacity())
+        # Production and capacity change at the moment an upgrade finishes
+        for finishes_at, building_name in self.get_finished_upgrades(at):
+            periods.append((max((finishes_at - produced_since).total_seconds(), 0), dict(levels)))
+            produced_since = max(produced_since, finishes_at)
+            if building_name in levels:
+                levels[building_name] += 1
+
+        periods.append((max((at - produced_since).total_seconds(), 0), levels))
+        return periods
 
-        self.save()
+    @staticmethod
+    def _get_production(levels) -> dict[str, float]:
+        return {
+            "wood": Sawmill.PRODUCTIONS[levels["sawmill"]],
+            "iron": IronMine.PRODUCTIONS[levels["iron_mine"]],
+            "clay": ClayPit.PRODUCTIONS[levels["clay_pit"]],
+        }
 
-    def upgrade_building_level(self, building_name):
+    def _change_resources(self, resources, change) -> dict[str, float]:
+        """
+        The production is settled in SQL starting from the stored state of the village, which is identified
+        by its last_resources_update. If another write has settled the village since it was loaded,
+        no row matches, the stored state is reloaded and the change retried. Returns the resources deducted or added.
+        """
+        for _ in range(self.CHANGE_RESOURCES_ATTEMPTS):
+            now = timezone.now()
+            stored_village = self._get_stored_village()
+            stored_last_resources_update = stored_village.last_resources_update
+
+            settled_expressions = {resource_name: F(resource_name) for resource_name in self.RESOURCE_NAMES}
+            for seconds_passed, levels in stored_village._get_production_periods(now):
+                warehouse_capacity = Value(float(Warehouse.CAPACITIES[levels["warehouse"]]))
+                production = self._get_production(levels)
+                settled_expressions = {
+                    resource_name: Least(
+                        expression + Value(production[resource_name] * seconds_passed), warehouse_capacity
+                    )
+                    for resource_name, expression in settled_expressions.items()
+                }
+
+            # The same settlement in Python, mirrored into this instance once the UPDATE succeeds
+            stored_village._settle_resources(now)
+            warehouse_capacity = stored_village.warehouse.get_capacity()
+
+            queryset = Village.objects.filter(pk=self.pk, last_resources_update=stored_last_resources_update)
+            if change == "charge":
+                queryset = queryset.alias(
+                    **{f"settled_{name}": expression for name, expression in settled_expressions.items()}
+                ).filter(**{f"settled_{name}__gte": resources[name] for name in self.RESOURCE_NAMES})
+                changed_expressions = {
+                    name: expression - Value(float(resources[name])) for name, expression in settled_expressions.items()
+                }
+                changed_amounts = {name: resources[name] for name in self.RESOURCE_NAMES}
+                changed_resources = {
+                    name: getattr(stored_village, name) - resources[name] for name in self.RESOURCE_NAMES
+                }
+            elif change == "plunder":
+                # Clamped in SQL as well, so resources spent meanwhile limit the plunder instead of failing it
+                changed_expressions = {
+                    name: Greatest(expression - Value(float(resources[name])), Value(0.0))
+                    for name, expression in settled_expressions.items()
+                }
+                changed_amounts = {
+                    name: min(getattr(stored_village, name), resources[name]) for name in self.RESOURCE_NAMES
+                }
+                changed_resources = {
+                    name: getattr(stored_village, name) - changed_amounts[name] for name in self.RESOURCE_NAMES
+                }
+            else:
+                changed_expressions = {
+                    name: Least(expression + Value(float(resources[name])), Value(float(warehouse_capacity)))
+                    for name, expression in settled_expressions.items()
+                }
+                changed_resources = {
+                    name: min(getattr(stored_village, name) + resources[name], warehouse_capacity)
+                    for name in self.RESOURCE_NAMES
+                }
+                changed_amounts = {
+                    name: changed_resources[name] - getattr(stored_village, name) for name in self.RESOURCE_NAMES
+                }
+
+            settled_fields = {
+                field: getattr(stored_village, field)
+                for field in self.SETTLED_FIELDS
+                if field not in self.RESOURCE_NAMES
+            }
+            if queryset.update(**changed_expressions, **settled_fields):
+                for field, value in {**settled_fields, **changed_resources}.items():
+                    setattr(self, field, value)
+
+                self._remember_stored_values(self.SETTLED_FIELDS)
+                return changed_amounts
+
+            self.refresh_from_db(fields=self.SETTLED_FIELDS)
+            if change == "charge" and self.last_resources_update == stored_last_resources_update:
+                raise exceptions.InsufficientResourcesException
+
+        raise exceptions.ResourcesConflictException
+
+    def _get_stored_village(self):
+        """Returns an unsaved village holding the stored values of SETTLED_FIELDS."""
+        stored_values = getattr(self, "_stored_values", {})
+        return Village(**{field: stored_values[field] for field in self.SETTLED_FIELDS if field in stored_values})
+
+    def upgrade_building_level(self, building_name, commit=True):
         if building_name == "town_hall":
             self.town_hall_level += 1
         elif building_name == "warehouse":
@@ -254,27 +499,29 @@ class Village(BaseModel):
         else:
             raise exceptions.BuildingNotFoundException
 
-        self.save()
+        if commit:
+            self.save_dirty_fields()
 
-    def set_building_upgrading_state(self, building_name, state):
+    def set_building_upgrade_finishes_at(self, building_name, finishes_at, commit=True):
         if building_name == "town_hall":
-            self.is_town_hall_upgrading = state
+            self.town_hall_upgrade_finishes_at = finishes_at
         elif building_name == "warehouse":
-            self.is_warehouse_upgrading = state
+            self.warehouse_upgrade_finishes_at = finishes_at
         elif building_name == "iron_mine":
-            self.is_iron_mine_upgrading = state
+            self.iron_mine_upgrade_finishes_at = finishes_at
         elif building_name == "clay_pit":
-            self.is_clay_pit_upgrading = state
+            self.clay_pit_upgrade_finishes_at = finishes_at
         elif building_name == "sawmill":
-            self.is_sawmill_upgrading = state
+            self.sawmill_upgrade_finishes_at = finishes_at
         elif building_name == "barracks":
-            self.is_barracks_upgrading = state
+            self.barracks_upgrade_finishes_at = finishes_at
         else:
             raise exceptions.BuildingNotFoundException
 
-        self.save()
+        if commit:
+            self.save_dirty_fields()
 
-    def increase_unit_count(self, unit_name, count):
+    def increase_unit_count(self, unit_name, count, commit=True):
         if unit_name == "spearman":
             self.spearman_count += count
         elif unit_name == "swordsman":
@@ -286,22 +533,106 @@ class Village(BaseModel):
         else:
             raise exceptions.UnitNotFoundException
 
-        self.save()
+        if commit:
+            self.save_dirty_fields()
+
+    def enqueue_units(self, units_to_train: list[tuple[str, int]], commit=True) -> datetime:
+        """
+        Appends one training batch per unit type behind the batches already in the queue.
+        Returns the time at which the last of the queued units is trained.
+        """
+        now = timezone.now()
+        finish_training_time = max(self.training_finishes_at or now, now)
+
+        for unit_name, unit_count in units_to_train:
+            if unit_count <= 0:
+                continue
+
+            unit = units.UNITS.get(unit_name)
+            if unit is None:
+                raise exceptions.UnitNotFoundException
+
+            self.training_queue.append(
+                {
+                    "name": unit_name,
+                    "count": unit_count,
+                    "startedAt": finish_training_time.isoformat(),
+                    "trainingTime": unit.TRAINING_TIME.total_seconds(),
+                }
+            )
+            finish_training_time += unit.get_training_time(unit_count)
+
+        if commit:
+            self.save_dirty_fields()
+        return finish_training_time
+
+    def update_units(self, commit=True):
+        """
+        Moves the units trained since the last update from the training queue into the barracks.
+        Batches are trained one after another, so only the first pending batch can be partially trained.
+        """
+        if not self.training_queue:
+            return
+
+        pending_batches = []
+        has_trained_units = False
+
+        for batch, trained_count in self._get_trained_counts(timezone.now()):
+            if trained_count > 0:
+                started_at = datetime.fromisoformat(batch["startedAt"])
+                has_trained_units = True
+                self.increase_unit_count(batch["name"], trained_count, commit=False)
+                batch = {
+                    **batch,
+                    "count": batch["count"] - trained_count,
+                    "startedAt": (started_at + timedelta(seconds=batch["trainingTime"] * trained_count)).isoformat(),
+                }
+
+            if batch["count"] > 0:
+                pending_batches.append(batch)
+
+        if has_trained_units:
+            self.training_queue = pending_batches
+            if commit:
+                self.save_dirty_fields()
+
+    def project_units(self, at=None) -> dict[str, int]:
+        """
+        Returns the unit counts the village has at the given instant (now by default), including the units
+        trained in the meantime. The village is left untouched.
+        """
+        counts = {unit_name: unit.count for unit_name, unit in self.units.items()}
+        for batch, trained_count in self._get_trained_counts(at or timezone.now()):
+            counts[batch["name"]] += trained_count
+
+        return counts
+
+    def _get_trained_counts(self, at) -> list[tuple[dict, int]]:
+        """Returns the batches of the training queue with the number of their units trained by the given instant."""
+        trained_counts = []
+        for batch in self.training_queue or ():
+            seconds_passed = (at - datetime.fromisoformat(batch["startedAt"])).total_seconds()
+            trained_counts.append((batch, min(batch["count"], max(int(seconds_passed // batch["trainingTime"]), 0))))
+
+        return trained_counts
 
     def get_building_upgrade_time(self, building: Building) -> float:
-        town_hall = self.town_hall
-        return (
-            building.BASE_UPGRADE_TIME
-            * (building.UPGRADE_TIME_FACTOR**building.level)
-            * (town_hall.UPGRADE_TIME_DISCOUNT ** (-town_hall.level))
-        ).total_seconds()
+        return building.get_upgrade_time(self.town_hall_level)
 
     def __str__(self):
         return f"Village {self.id}"
 
 
+class BattleQuerySet(models.QuerySet):
+    def battle_log(self):
+        """The most recent battles, with the players and villages BattleLogSerializer reads."""
+        battles = self.select_related("attacker__village", "defender__village").order_by("-start_time")
+        return battles[: Battle.BATTLE_LOG_SIZE]
+
+
 class Battle(BaseModel):
     BASE_MORALE_LOSS = 25
+    BATTLE_LOG_SIZE = 10
 
     class BattlePhase(models.TextChoices):
         ONGOING = "O", "Ongoing"
@@ -315,6 +646,11 @@ class Battle(BaseModel):
     phase = models.CharField(max_length=1, choices=BattlePhase.choices, default=BattlePhase.ONGOING)
     result = models.CharField(max_length=1, choices=BattleResult.choices, null=True)
 
+    objects = BattleQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=["game_session", "-start_time"], name="battle_log_idx")]
+
     game_session = models.ForeignKey(
         "GameSession", on_delete=models.CASCADE, null=True, db_index=True, related_name="battles"
     )
@@ -0,0 +1,169 @@
+"""
+Outbound messages to the websocket consumers.
+
+Within a batch (a `with NotificationBatch():` block or a function decorated with `batched`) messages are collected
+instead of sent. When the outermost batch exits, after the surrounding transaction commits, the messages of each
+group are merged into one envelope, handled by GameSessionConsumer.send_messages:
+    {"type": "send_messages", "data": [{"type": "fetch_units", ...}, {"type": "message", ...}]}
+and the envelopes of all groups are sent concurrently by the Publisher.
+A group with a single message gets the usual {"type": "send_message", "data": {...}} event.
+
+Messages sent outside a batch are a batch of their own, so nothing is announced before (or without) the commit of
+the transaction that made the change. Views and tasks return as soon as the messages are queued to the Publisher,
+which sends them from its own thread.
+"""
+
+import asyncio
+import functools
+import logging
+from contextvars import ContextVar
+from typing import Optional
+
+from channels.layers import get_channel_layer
+from django.db import connection, transaction
+
+from utils.event_loop import BackgroundEventLoop
+
+logger = logging.getLogger(__name__)
+
+_current_batch: ContextVar[Optional["NotificationBatch"]] = ContextVar("notification_batch", default=None)
+
+
+def send(group: str, data: dict) -> None:
+    batch = _current_batch.get()
+    if batch is None:
+        with NotificationBatch() as batch:
+            batch.add(group, data)
+    else:
+        batch.add(group, data)
+
+
+class NotificationBatch:
+    def __init__(self) -> None:
+        self.messages: dict[str, list[dict]] = {}
+        self._token = None
+
+    def __enter__(self) -> "NotificationBatch":
+        # Nested batches join the outermost one
+        if _current_batch.get() is None:
+            self._token = _current_batch.set(self)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self._token is None:
+            return
+
+        _current_batch.reset(self._token)
+        self._token = None
+
+        # The messages of a failed command describe changes which did not happen
+        if exc_type is not None:
+            return
+
+        if connection.in_atomic_block:
+            transaction.on_commit(self.flush)
+        else:
+            self.flush()
+
+    def add(self, group: str, data: dict) -> None:
+        self.messages.setdefault(str(group), []).append(data)
+
+    def flush(self) -> None:
+        messages, self.messages = self.messages, {}
+        _send_all(messages)
+
+
+def batched(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with NotificationBatch():
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+class Publisher:
+    """
+    Sends messages from sync code (views, Celery tasks) without blocking the caller.
+    Published batches are queued to a long-lived event loop thread and sent one after another, in the order
+    they were published, so the channel layer keeps its Redis connections instead of setting them up again
+    for every async_to_sync call.
+    Batches which pile up while the previous ones are sent are merged, up to MAX_MERGED_BATCHES at once,
+    keeping the order of the messages of each group.
+    """
+
+    MAX_MERGED_BATCHES = 100
+
+    def __init__(self) -> None:
+        self._event_loop = BackgroundEventLoop("notification-publisher")
+        self._queue: Optional[asyncio.Queue] = None
+
+    def publish(self, messages: dict[str, list[dict]]) -> None:
+        self._event_loop.call_soon(self._enqueue, messages)
+
+    def wait_until_sent(self, timeout: Optional[float] = None) -> None:
+        """Blocks until everything published so far has been sent."""
+        self._event_loop.submit(self._join()).result(timeout)
+
+    def _enqueue(self, messages: dict[str, list[dict]]) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._event_loop.loop.create_task(self._send_forever())
+
+        self._queue.put_nowait(messages)
+
+    async def _send_forever(self) -> None:
+        while True:
+            batches = [await self._queue.get()]
+            while not self._queue.empty() and len(batches) < self.MAX_MERGED_BATCHES:
+                batches.append(self._queue.get_nowait())
+
+            messages = _merge(batches)
+            try:
+                await _group_send_all(messages)
+            except Exception:
+                logger.exception("Sending notifications to %s failed", list(messages))
+            finally:
+                for _ in batches:
+                    self._queue.task_done()
+
+    async def _join(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+
+
+@functools.cache
+def get_publisher() -> Publisher:
+    return Publisher()
+
+
+def _send_all(messages: dict[str, list[dict]]) -> None:
+    if messages:
+        get_publisher().publish(messages)
+
+
+def _merge(batches: list[dict[str, list[dict]]]) -> dict[str, list[dict]]:
+    merged: dict[str, list[dict]] = {}
+    for messages in batches:
+        for group, group_messages in messages.items():
+            merged.setdefault(group, []).extend(group_messages)
+
+    return merged
+
+
+async def _group_send_all(messages: dict[str, list[dict]]) -> None:
+    channel_layer = get_channel_layer()
+    await asyncio.gather(
+        *(
+            channel_layer.group_send(str(group), _get_event(group_messages))
+            for group, group_messages in messages.items()
+        )
+    )
+
+
+def _get_event(messages: list[dict]) -> dict:
+    if len(messages) == 1:
+        return {"type": "send_message", "data": messages[0]}
+
+    return {"type": "send_messages", "data": messages}
@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import logging
+import time
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import cache
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from game import models, tasks
+from utils.event_loop import BackgroundEventLoop
+
+logger = logging.getLogger(__name__)
+
+
+def get_event_handler(event_name: str):
+    handlers = {
+        "upgrade_building": tasks.upgrade_building_task,
+        "units_trained": tasks.units_trained_task,
+        "broadcast_leaderboard": tasks.broadcast_leaderboard_task,
+        "end_game": tasks.end_game_task,
+        "attack": tasks.attack_task,
+        "return_units": tasks.return_units_task,
+        "send_delayed_message": tasks.send_delayed_message_task,
+    }
+
+    try:
+        return handlers[event_name]
+    except KeyError:
+        raise ValueError(f"Unknown game event: {event_name}")
+
+
+def run_event(event_name: str, args: tuple) -> bool:
+    """Runs the event handler in the current thread, outside Celery. Returns whether the handler succeeded."""
+    close_old_connections()
+    try:
+        get_event_handler(event_name).run(*args)
+    except Exception:
+        logger.exception("Game event %s%s failed", event_name, tuple(args))
+        return False
+    finally:
+        close_old_connections()
+
+    return True
+
+
+def get_game_queue(game_session_id: int) -> str:
+    """The Celery queue of the game session, one of settings.GAME_TASK_QUEUES queues."""
+    return f"game-{zlib.crc32(str(game_session_id).encode()) % settings.GAME_TASK_QUEUES}"
+
+
+class Scheduler(ABC):
+    @abstractmethod
+    def schedule(self, event_name: str, args: tuple, eta: datetime, game_session_id: Optional[int] = None) -> None:
+        """Runs the handler of the event with the given args at the eta."""
+
+
+class CeleryScheduler(Scheduler):
+    """
+    Every event is a Celery task with an ETA. The events of a game session are routed to the same game-N queue,
+    so with a single worker process per queue they run one after another, without racing for the same rows.
+    """
+
+    def schedule(self, event_name: str, args: tuple, eta: datetime, game_session_id: Optional[int] = None) -> None:
+        queue = get_game_queue(game_session_id) if game_session_id is not None else None
+        get_event_handler(event_name).apply_async(args, eta=eta, queue=queue)
+
+
+class DatabaseScheduler(Scheduler):
+    """
+    Events are rows in the ScheduledEvent table, so they survive restarts and long ETAs cost no worker memory.
+    A single dispatcher loop (`manage.py dispatch_events`) drains the due events in batches.
+
+    A row is deleted only after its handler has run, so events are run at least once: the events of a dispatcher
+    which died while running them are claimed again after CLAIM_TIMEOUT. Failed events are retried after
+    CLAIM_TIMEOUT as well, up to MAX_ATTEMPTS times, then they are kept in the table for inspection.
+    """
+
+    BATCH_SIZE = 100
+    POLL_INTERVAL = 0.5  # seconds
+    CLAIM_TIMEOUT = timedelta(minutes=5)
+    MAX_ATTEMPTS = 3
+
+    def schedule(self, event_name: str, args: tuple, eta: datetime, game_session_id: Optional[int] = None) -> None:
+        get_event_handler(event_name)
+        models.ScheduledEvent.objects.create(name=event_name, args=list(args), eta=eta)
+
+    def dispatch_due_events(self, now: Optional[datetime] = None) -> int:
+        """Claims one batch of due events, runs them in the order they are due and returns how many were run."""
+        now = now or timezone.now()
+
+        with transaction.atomic():
+            events = list(
+                models.ScheduledEvent.objects.select_for_update(skip_locked=True)
+                .filter(eta__lte=now, attempts__lt=self.MAX_ATTEMPTS)
+                .filter(Q(started_at__isnull=True) | Q(started_at__lte=now - self.CLAIM_TIMEOUT))
+                .order_by("eta", "id")[: self.BATCH_SIZE]
+            )
+            models.ScheduledEvent.objects.filter(id__in=[event.id for event in events]).update(
+                started_at=now, attempts=F("attempts") + 1
+            )
+
+        for event in events:
+            if run_event(event.name, event.args):
+                models.ScheduledEvent.objects.filter(id=event.id).delete()
+
+        return len(events)
+
+    def run_forever(self) -> None:
+        while True:
+            if self.dispatch_due_events() < self.BATCH_SIZE:
+                time.sleep(self.POLL_INTERVAL)
+
+
+class AsyncioScheduler(Scheduler):
+    """
+    Events are kept in a heap served by an asyncio loop embedded in the current (Daphne) process,
+    with a single timer armed for the earliest event. Handlers run one at a time in ETA order, in a single
+    worker thread, so events of the same village do not race.
+    Meant for single node deployments without Celery, pending events are lost when the process exits.
+    """
+
+    def __init__(self) -> None:
+        self._events: list[tuple[float, int, str, tuple]] = []
+        self._sequence = itertools.count()
+        self._timer = None
+        self._event_loop = BackgroundEventLoop("game-scheduler")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="game-scheduler-events")
+
+    def schedule(self, event_name: str, args: tuple, eta: datetime, game_session_id: Optional[int] = None) -> None:
+        get_event_handler(event_name)
+        self._event_loop.call_soon(self._push, (eta.timestamp(), next(self._sequence), event_name, tuple(args)))
+
+    def _push(self, event) -> None:
+        heapq.heappush(self._events, event)
+        if self._events[0] is event:
+            self._arm_timer()
+
+    def _arm_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._events:
+            delay = max(self._events[0][0] - time.time(), 0)
+            self._timer = self._event_loop.loop.call_later(delay, self._fire_due_events)
+
+    def _fire_due_events(self) -> None:
+        self._timer = None
+        now = time.time()
+
+        while self._events and self._events[0][0] <= now:
+            _, _, event_name, args = heapq.heappop(self._events)
+            self._event_loop.loop.run_in_executor(self._executor, run_event, event_name, args)
+
+        self._arm_timer()
+
+
+@cache
+def get_scheduler() -> Scheduler:
+    return import_string(settings.GAME_SCHEDULER_BACKEND)()
+
+
+def schedule_event(event_name: str, *args, eta: datetime, game_session_id: Optional[int] = None) -> None:
+    get_scheduler().schedule(event_name, args, eta, game_session_id)
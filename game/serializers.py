@@ -1,8 +1,10 @@
+from datetime import datetime, timedelta
+
 from rest_framework import serializers
 
-from game.buildings import Building
+from game.buildings import BUILDINGS, Building, ResourceBuilding, TownHall, Warehouse
 from game.models import Player, Village, GameSession, Battle
-from game.units import Unit
+from game.units import UNITS, Unit
 
 
 class CreateGameSessionSerializer(serializers.Serializer):
@@ -50,8 +52,10 @@ class ResourcesSerializer(serializers.Serializer):
     resources = serializers.DictField()
     resourcesIncome = serializers.DictField()
     resourcesCapacity = serializers.IntegerField()
+    asOf = serializers.DateTimeField()
 
     def to_representation(self, instance: Village):
+        # Clients project the current amounts: min(resources + resourcesIncome * (now - asOf), resourcesCapacity)
         return {
             "resources": instance.resources,
             "resourcesIncome": {
@@ -60,31 +64,34 @@ class ResourcesSerializer(serializers.Serializer):
                 "iron": instance.iron_mine.get_production(),
             },
             "resourcesCapacity": instance.warehouse.get_capacity(),
+            "asOf": instance.last_resources_update.isoformat() if instance.last_resources_update else None,
         }
 
 
 class BuldingSerializer(serializers.Serializer):
     level = serializers.IntegerField()
-    max_level = serializers.IntegerField()
-    upgrade_cost = serializers.DictField()
-    upgrade_duration = serializers.IntegerField()
+    upgrade_finishes_at = serializers.DateTimeField()
 
     def to_representation(self, instance: Building):
-        village = self.context.get("village")
-        if village:
-            upgrade_duration = village.get_building_upgrade_time(instance)
-        else:
-            upgrade_duration = instance.BASE_UPGRADE_TIME
+        # Costs and durations of each level are served once by GameDataView
+        upgrade_finishes_at = self.context.get("upgrade_finishes_at")
 
         return {
             "level": instance.level,
-            "maxLevel": instance.MAX_LEVEL,
-            "upgradeCost": instance.get_upgrade_cost(),
-            "upgradeDuration": int(upgrade_duration),
+            "upgradeFinishesAt": upgrade_finishes_at.isoformat() if upgrade_finishes_at else None,
         }
 
 
 class VillageSerializer(serializers.ModelSerializer):
+    BUILDING_KEYS = {
+        "town_hall": "townHall",
+        "warehouse": "warehouse",
+        "sawmill": "sawmill",
+        "clay_pit": "clayPit",
+        "iron_mine": "ironMine",
+        "barracks": "barracks",
+    }
+
     buildings = serializers.SerializerMethodField()
 
     class Meta:
@@ -92,18 +99,38 @@ class VillageSerializer(serializers.ModelSerializer):
         fields = ("buildings",)
 
     def get_buildings(self, instance: Village):
+        # Only these buildings are serialized if given, for partial updates
+        building_names = self.context.get("building_names", self.BUILDING_KEYS.keys())
+        buildings = instance.buildings
+        upgrade_finishes_at = instance.buildings_upgrade_finishes_at
+
         return {
-            "townHall": BuldingSerializer(instance.town_hall, context={"village": instance}).data,
-            "warehouse": BuldingSerializer(instance.warehouse, context={"village": instance}).data,
-            "sawmill": BuldingSerializer(instance.sawmill, context={"village": instance}).data,
-            "clayPit": BuldingSerializer(instance.clay_pit, context={"village": instance}).data,
-            "ironMine": BuldingSerializer(instance.iron_mine, context={"village": instance}).data,
-            "barracks": BuldingSerializer(instance.barracks, context={"village": instance}).data,
+            self.BUILDING_KEYS[building_name]: BuldingSerializer(
+                buildings[building_name],
+                context={"upgrade_finishes_at": upgrade_finishes_at[building_name]},
+            ).data
+            for building_name in building_names
+        }
+
+
+class TrainingBatchSerializer(serializers.Serializer):
+    def to_representation(self, instance: dict):
+        started_at = datetime.fromisoformat(instance["startedAt"])
+        finishes_at = started_at + timedelta(seconds=instance["trainingTime"] * instance["count"])
+
+        return {
+            "name": instance["name"],
+            "count": instance["count"],
+            # Seconds as stored, a truncated duration would drift from finishesAt
+            "trainingDuration": instance["trainingTime"],
+            "startedAt": started_at.isoformat(),
+            "finishesAt": finishes_at.isoformat(),
         }
 
 
 class UnitsCountInVillageSerializer(serializers.Serializer):
     units = serializers.SerializerMethodField()
+    trainingQueue = TrainingBatchSerializer(source="training_queue", many=True)
 
     def get_units(self, instance: Village):
         return {
@@ -114,40 +141,71 @@ class UnitsCountInVillageSerializer(serializers.Serializer):
         }
 
 
-class UnitSerializer(serializers.Serializer):
+class UnitDataSerializer(serializers.Serializer):
     speed = serializers.IntegerField()
     trainingDuration = serializers.IntegerField()
     training_cost = serializers.DictField()
     carrying_capacity = serializers.IntegerField()
     offensive_strength = serializers.IntegerField()
     defensive_strength = serializers.IntegerField()
-    count = serializers.IntegerField()
+    points = serializers.IntegerField()
 
-    def to_representation(self, instance: Unit):
+    def to_representation(self, instance: type[Unit]):
         return {
-            "count": instance.count,
             "speed": int(instance.SPEED.total_seconds()),
             "trainingDuration": int(instance.TRAINING_TIME.total_seconds()),
             "trainingCost": instance.get_training_cost(1),
             "carryingCapacity": instance.CARRYING_CAPACITY,
             "offensiveStrength": instance.OFFENSIVE_STRENGTH,
             "defensiveStrength": instance.DEFENSIVE_STRENGTH,
+            "points": instance.POINTS_PER_UNIT,
         }
 
 
-class UnitsInVillageSerializer(serializers.Serializer):
+class BuildingDataSerializer(serializers.Serializer):
+    max_level = serializers.IntegerField()
+    points_per_level = serializers.IntegerField()
+    upgrade_costs = serializers.ListField()
+    upgrade_durations = serializers.ListField()
+
+    def to_representation(self, instance: type[Building]):
+        # Lists are indexed by level, starting with level 1
+        levels = range(1, instance.MAX_LEVEL + 1)
+        data = {
+            "maxLevel": instance.MAX_LEVEL,
+            "pointsPerLevel": instance.POINTS_PER_LEVEL,
+            "upgradeCosts": [dict(instance.UPGRADE_COSTS[level]) for level in levels],
+            "upgradeDurations": [instance.UPGRADE_TIMES[level].total_seconds() for level in levels],
+        }
+
+        if issubclass(instance, TownHall):
+            data["upgradeTimeDiscounts"] = [instance.UPGRADE_TIME_DISCOUNTS[level] for level in levels]
+        if issubclass(instance, Warehouse):
+            data["capacities"] = [instance.CAPACITIES[level] for level in levels]
+        if issubclass(instance, ResourceBuilding):
+            data["productions"] = [instance.PRODUCTIONS[level] for level in levels]
+
+        return data
+
+
+class GameDataSerializer(serializers.Serializer):
     units = serializers.SerializerMethodField()
+    buildings = serializers.SerializerMethodField()
 
-    def get_units(self, instance: Village):
+    def get_units(self, instance):
+        return {unit_name: UnitDataSerializer(unit).data for unit_name, unit in UNITS.items()}
+
+    def get_buildings(self, instance):
         return {
-            "spearman": UnitSerializer(instance.spearman).data,
-            "swordsman": UnitSerializer(instance.swordsman).data,
-            "axeman": UnitSerializer(instance.axeman).data,
-            "archer": UnitSerializer(instance.archer).data,
+            key: BuildingDataSerializer(BUILDINGS[building_name]).data
+            for building_name, key in VillageSerializer.BUILDING_KEYS.items()
         }
 
 
 class PlayerResultsSerializer(serializers.ModelSerializer):
+    # Annotated by PlayerQuerySet.with_points
+    points = serializers.IntegerField(source="total_points")
+
     class Meta:
         model = Player
         fields = ("id", "nickname", "points")
@@ -1,13 +1,17 @@
+import functools
+import hashlib
+import json
 import random
+from datetime import timedelta
 from math import sqrt, pow
 from typing import OrderedDict
 
+from django.core.cache import cache
 from django.utils import timezone
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from plemiona_api.celery import app
 
-from game import exceptions, serializers, models, tasks, units
+from game import combat, exceptions, notifications, serializers, models, scheduler, units
+from utils.unit_of_work import UnitOfWork
 
 
 class GameSessionConsumerService:
@@ -18,6 +22,7 @@ class GameSessionConsumerService:
             "data": {
                 "players": serializers.PlayerDataSerializer(game_session.player_set.all(), many=True).data,
                 "endedAt": game_session.ended_at.isoformat(),
+                "gameDataVersion": GameDataService.get_game_data()["version"],
             },
         }
         GameSessionConsumerService._send_message(game_session.game_code, data)
@@ -31,15 +36,22 @@ class GameSessionConsumerService:
         GameSessionConsumerService._send_message(player.channel_name, data)
 
     @staticmethod
-    def send_fetch_buildings(player: models.Player):
+    def send_fetch_buildings(player: models.Player, building_names=None):
+        """
+        Sends the given buildings only, if specified. Consumers merge them into the state they have already sent
+        to the client, see game/deltas.py.
+        """
+        player.village.update_resources(commit=False)
+        context = {"building_names": building_names} if building_names else {}
         data = {
             "type": "fetch_buildings",
-            "data": serializers.VillageSerializer(player.village).data,
+            "data": serializers.VillageSerializer(player.village, context=context).data,
         }
         GameSessionConsumerService._send_message(player.channel_name, data)
 
     @staticmethod
     def send_fetch_units_count(player: models.Player):
+        player.village.update_units(commit=False)
         data = {
             "type": "fetch_units",
             "data": serializers.UnitsCountInVillageSerializer(player.village).data,
@@ -47,20 +59,23 @@ class GameSessionConsumerService:
         GameSessionConsumerService._send_message(player.channel_name, data)
 
     @staticmethod
-    def send_fetch_units(player: models.Player):
+    def send_fetch_leaderboard(game_session: models.GameSession):
+        players = game_session.player_set.leaderboard()
         data = {
-            "type": "fetch_units",
-            "data": serializers.UnitsInVillageSerializer(player.village).data,
+            "type": "fetch_leaderboard",
+            "data": {
+                "leaderboard": serializers.PlayerResultsSerializer(players, many=True).data,
+            },
         }
-        GameSessionConsumerService._send_message(player.channel_name, data)
+        GameSessionConsumerService._send_message(game_session.game_code, data)
 
     @staticmethod
-    def send_fetch_leaderboard(game_session: models.GameSession):
-        player_results_list = serializers.PlayerResultsSerializer(game_session.player_set.all(), many=True).data
+    def send_live_leaderboard(game_session: models.GameSession):
+        players = game_session.player_set.live_leaderboard()
         data = {
-            "type": "fetch_leaderboard",
+            "type": "leaderboard",
             "data": {
-                "leaderboard": sorted(player_results_list, key=lambda x: x["points"], reverse=True),
+                "leaderboard": serializers.PlayerResultsSerializer(players, many=True).data,
             },
         }
         GameSessionConsumerService._send_message(game_session.game_code, data)
@@ -76,16 +91,13 @@ class GameSessionConsumerService:
         GameSessionConsumerService._send_message(player.channel_name, data)
 
     @staticmethod
-    def send_battle_log(game_session: models.GameSession):
-        battles = game_session.battles.order_by("-start_time")[:10]
-
+    def send_battle_log_entry(battle: models.Battle):
+        """Sends the new or changed entry only, clients get the whole battle log on connect."""
         data = {
-            "type": "battle_log",
-            "data": {
-                "battleLog": serializers.BattleLogSerializer(battles, many=True).data,
-            },
+            "type": "battle_log_entry",
+            "data": BattleLogService.save_entry(battle),
         }
-        GameSessionConsumerService._send_message(game_session.game_code, data)
+        GameSessionConsumerService._send_message(battle.game_session.game_code, data)
 
     @staticmethod
     def inform_player(player: models.Player, message: str):
@@ -99,14 +111,27 @@ class GameSessionConsumerService:
 
     @staticmethod
     def _send_message(channel_name, data):
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            str(channel_name),
-            {
-                "type": "send_message",
-                "data": data,
-            },
-        )
+        # Merged with the other messages of the command if sent within a batch, see game/notifications.py
+        notifications.send(str(channel_name), data)
+
+
+class GameDataService:
+    VERSION_LENGTH = 16
+
+    @staticmethod
+    @functools.cache
+    def get_game_data() -> dict:
+        """
+        Returns the unit and building statistics, which only change with a deploy.
+        The version is a hash of the content, clients refetch the data once it changes.
+        """
+        data = serializers.GameDataSerializer({}).data
+        content = json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+        return {
+            "version": hashlib.sha256(content.encode()).hexdigest()[: GameDataService.VERSION_LENGTH],
+            **data,
+        }
 
 
 class GameSessionService:
@@ -143,6 +168,7 @@ class GameSessionService:
         return player
 
     @staticmethod
+    @notifications.batched
     def start_game_session(player):
         game_session = player.game_session
         if player != game_session.owner:
@@ -154,35 +180,49 @@ class GameSessionService:
         if game_session.player_set.count() < models.GameSession.MINIMUM_PLAYERS:
             raise exceptions.MinimumPlayersNotReachedException
 
-        game_session.has_started = True
-        game_session.ended_at = timezone.now() + models.GameSession.DURATION
-        game_session.save()
+        with UnitOfWork() as unit_of_work:
+            game_session.has_started = True
+            game_session.ended_at = timezone.now() + models.GameSession.DURATION
+            unit_of_work.register(game_session)
+
+            # Start gathering resources for all players
+            village_queryset = models.Village.objects.filter(player__game_session=game_session)
+            village_queryset.update(last_resources_update=timezone.now(), points=models.Village.get_points_expression())
 
-        # Start gathering resources for all players
-        village_queryset = models.Village.objects.filter(player__game_session=game_session)
-        village_queryset.update(last_resources_update=timezone.now())
+            CoordinateService.set_coordinates(game_session)
 
-        CoordinateService.set_coordinates(game_session)
         GameSessionConsumerService.send_start_game_session(game_session)
         for player in game_session.player_set.all():
             GameSessionConsumerService.send_fetch_resources(player)
             GameSessionConsumerService.send_fetch_buildings(player)
-            GameSessionConsumerService.send_fetch_units(player)
+            GameSessionConsumerService.send_fetch_units_count(player)
 
-        tasks.end_game_task.apply_async((game_session.id,), eta=game_session.ended_at)
+        scheduler.schedule_event(
+            "end_game", game_session.id, eta=game_session.ended_at, game_session_id=game_session.id
+        )
 
     @staticmethod
+    @notifications.batched
     def end_game_session(game_session):
-        for task in game_session.task_set.all():
-            if not task.has_ended:
-                app.control.revoke(task.task_id, terminate=True)
-                task.has_ended = True
+        with UnitOfWork() as unit_of_work:
+            for player in game_session.player_set.select_related("village"):
+                # The leaderboard is computed from the stored villages, so the final settlement is saved
+                player.village.update_resources(commit=False)
+                player.village.update_units(commit=False)
+                unit_of_work.register(player.village, fields=models.Village.SETTLED_FIELDS)
+
+            for task in game_session.task_set.all():
+                if not task.has_ended:
+                    app.control.revoke(task.task_id, terminate=True)
+                    task.has_ended = True
+                    unit_of_work.register(task)
 
         GameSessionConsumerService.send_fetch_leaderboard(game_session)
 
 
 class VillageService:
     @staticmethod
+    @notifications.batched
     def upgrade_building(player, building_name):
         if building_name not in models.Village.BUILDING_NAMES:
             raise exceptions.BuildingNotFoundException
@@ -194,23 +234,35 @@ class VillageService:
             raise exceptions.GameSessionAlreadyEndedException
 
         village = player.village
-        village.update_resources()
+        with UnitOfWork() as unit_of_work:
+            village.update_resources(commit=False)
 
-        if village.buildings_upgrading_state[building_name]:
-            raise exceptions.BuildingUpgradeException
+            if village.buildings_upgrading_state[building_name]:
+                raise exceptions.BuildingUpgradeException
 
-        building = village.buildings[building_name]
-        building.validate_upgrade()
+            building = village.buildings[building_name]
+            building.validate_upgrade()
 
-        upgrade_costs = building.get_upgrade_cost()
-        village.charge_resources(upgrade_costs)
-        village.set_building_upgrading_state(building_name, False)
-        GameSessionConsumerService.send_fetch_resources(player)
+            upgrade_costs = building.get_upgrade_cost()
+            upgrade_finishes_at = timezone.now() + timedelta(seconds=village.get_building_upgrade_time(building))
+            village.charge_resources(upgrade_costs)
+            village.set_building_upgrade_finishes_at(building_name, upgrade_finishes_at, commit=False)
+            unit_of_work.register(village)
 
-        upgrade_time = village.get_building_upgrade_time(building)
-        tasks.upgrade_building_task.apply_async((player.id, building_name), countdown=upgrade_time)
+        GameSessionConsumerService.send_fetch_resources(player)
+        GameSessionConsumerService.send_fetch_buildings(player, building_names=(building_name,))
+
+        # The upgrade is applied by update_resources once finished, the task only notifies the player
+        scheduler.schedule_event(
+            "upgrade_building",
+            player.id,
+            building_name,
+            eta=upgrade_finishes_at,
+            game_session_id=player.game_session_id,
+        )
 
     @staticmethod
+    @notifications.batched
     def train_units(player, units_to_train: list[OrderedDict]):
         if not player.game_session.has_started:
             raise exceptions.GameSessionNotStartedException
@@ -218,9 +270,6 @@ class VillageService:
         if player.game_session.has_ended:
             raise exceptions.GameSessionAlreadyEndedException
 
-        if player.village.are_units_training:
-            raise exceptions.UnitsAreAlreadyBeingTrainedException
-
         accumulated_cost = {"wood": 0, "clay": 0, "iron": 0}
         units_count = 0
 
@@ -236,29 +285,79 @@ class VillageService:
             raise exceptions.NoUnitsToTrainException
 
         village = player.village
-        village.update_resources()
-        village.charge_resources(accumulated_cost)
+        with UnitOfWork() as unit_of_work:
+            village.update_resources(commit=False)
+            village.charge_resources(accumulated_cost)
+            finish_training_time = village.enqueue_units(
+                [(unit["name"], unit["count"]) for unit in units_to_train], commit=False
+            )
+            unit_of_work.register(village)
+
         GameSessionConsumerService.send_fetch_resources(player)
+        GameSessionConsumerService.send_fetch_units_count(player)
 
-        finish_training_time = timezone.now()
+        scheduler.schedule_event(
+            "units_trained", player.id, eta=finish_training_time, game_session_id=player.game_session_id
+        )
 
-        for unit in units_to_train:
-            unit_name, unit_count = unit["name"], unit["count"]
-            training_time = units.UNITS[unit_name].get_training_time(1)
+    @staticmethod
+    @notifications.batched
+    def attack_player(attacker: models.Player, defender: models.Player, attacker_units: list[OrderedDict]):
+        attacker_units_dict, attack_time = VillageService.get_attack_plan(attacker, defender, attacker_units)
+        battle = models.Battle(
+            game_session=attacker.game_session,
+            attacker=attacker,
+            defender=defender,
+            battle_time=timezone.now() + attack_time,
+            attacker_spearman_count=attacker_units_dict.get("spearman", 0),
+            attacker_swordsman_count=attacker_units_dict.get("swordsman", 0),
+            attacker_axeman_count=attacker_units_dict.get("axeman", 0),
+            attacker_archer_count=attacker_units_dict.get("archer", 0),
+        )
 
-            for _ in range(unit_count):
-                finish_training_time += training_time
-                tasks.train_unit_task.apply_async((player.id, unit_name), eta=finish_training_time)
+        BattleService.send_units(battle)
 
-        tasks.send_delayed_message_task.apply_async(
-            (player.id, "Units are ready to be picked up!"), eta=finish_training_time
+    @staticmethod
+    def preview_attack(attacker: models.Player, defender: models.Player, attacker_units: list[OrderedDict]) -> dict:
+        """
+        Resolves the attack with the combat math of battle_phase, against the units and resources the defender
+        will have when the attack arrives, trained and produced in the meantime included.
+        Nothing is saved or scheduled.
+        """
+        attacker_units_dict, attack_time = VillageService.get_attack_plan(attacker, defender, attacker_units)
+        battle_time = timezone.now() + attack_time
+
+        defender_units = defender.village.project_units(at=battle_time)
+        resources = defender.village.project_resources(at=battle_time)
+        outcome = combat.resolve_battle(
+            tuple(attacker_units_dict.get(unit_name, 0) for unit_name in models.Village.UNIT_NAMES),
+            tuple(defender_units[unit_name] for unit_name in models.Village.UNIT_NAMES),
+            tuple(resources[resource_name] for resource_name in models.Village.RESOURCE_NAMES),
         )
 
+        return {
+            "travelTime": attack_time.total_seconds(),
+            "battleTime": battle_time.isoformat(),
+            "result": models.Battle.BattleResult.WIN if outcome.is_attacker_winner else models.Battle.BattleResult.LOSE,
+            "attackerStrength": outcome.attacker_strength,
+            "defenderStrength": outcome.defender_strength,
+            "leftAttackerUnits": dict(zip(models.Village.UNIT_NAMES, outcome.left_attacker_counts)),
+            "leftDefenderUnits": dict(zip(models.Village.UNIT_NAMES, outcome.left_defender_counts)),
+            "attackerLostMorale": outcome.attacker_lost_morale,
+            "defenderLostMorale": outcome.defender_lost_morale,
+            "plunderedResources": dict(zip(models.Village.RESOURCE_NAMES, outcome.plundered_resources)),
+        }
+
     @staticmethod
-    def attack_player(attacker: models.Player, defender: models.Player, attacker_units: list[OrderedDict]):
+    def get_attack_plan(
+        attacker: models.Player, defender: models.Player, attacker_units: list[OrderedDict]
+    ) -> tuple[dict[str, int], timedelta]:
+        """Checks the attack and returns the counts of the sent units by name and the travel time of the slowest."""
         if attacker == defender:
             raise exceptions.CannotAttackYourselfException
 
+        attacker.village.update_units(commit=False)
+
         slowest_unit = None
         attacker_units_dict = {}
 
@@ -283,138 +382,234 @@ class VillageService:
             pow(attacker.village.x - defender.village.x, 2) + pow(attacker.village.y - defender.village.y, 2)
         )
 
-        attack_time = slowest_unit.get_speed(distance)
-        battle = models.Battle.objects.create(
-            game_session=attacker.game_session,
-            attacker=attacker,
-            defender=defender,
-            battle_time=timezone.now() + attack_time,
-            attacker_spearman_count=attacker_units_dict.get("spearman", 0),
-            attacker_swordsman_count=attacker_units_dict.get("swordsman", 0),
-            attacker_axeman_count=attacker_units_dict.get("axeman", 0),
-            attacker_archer_count=attacker_units_dict.get("archer", 0),
-        )
-
-        BattleService.send_units(battle)
+        return attacker_units_dict, slowest_unit.get_speed(distance)
 
 
 class BattleService:
     @staticmethod
     def send_units(battle: models.Battle):
-        battle.attacker.village.spearman_count -= battle.attacker_spearman_count
-        battle.attacker.village.swordsman_count -= battle.attacker_swordsman_count
-        battle.attacker.village.axeman_count -= battle.attacker_axeman_count
-        battle.attacker.village.archer_count -= battle.attacker_archer_count
+        with UnitOfWork() as unit_of_work:
+            battle.attacker.village.spearman_count -= battle.attacker_spearman_count
+            battle.attacker.village.swordsman_count -= battle.attacker_swordsman_count
+            battle.attacker.village.axeman_count -= battle.attacker_axeman_count
+            battle.attacker.village.archer_count -= battle.attacker_archer_count
+            unit_of_work.register(battle, battle.attacker.village)
 
-        battle.attacker.village.save()
         GameSessionConsumerService.send_fetch_units_count(battle.attacker)
         GameSessionConsumerService.inform_player(battle.defender, f"{battle.attacker.nickname}'s units are incoming!")
-        GameSessionConsumerService.send_battle_log(battle.attacker.game_session)
+        LeaderboardService.update_points(battle.attacker)
+        GameSessionConsumerService.send_battle_log_entry(battle)
 
-        tasks.attack_task.apply_async((battle.id,), eta=battle.battle_time)
+        scheduler.schedule_event("attack", battle.id, eta=battle.battle_time, game_session_id=battle.game_session_id)
 
     @staticmethod
+    @notifications.batched
     def battle_phase(battle: models.Battle):
         attacker = battle.attacker
         defender = battle.defender
-        defender.village.update_resources()
-
-        battle.defender_spearman_count = defender.village.units["spearman"].count
-        battle.defender_swordsman_count = defender.village.units["swordsman"].count
-        battle.defender_axeman_count = defender.village.units["axeman"].count
-        battle.defender_archer_count = defender.village.units["archer"].count
-
-        battle.defender_strenght = 1 + sum([unit.defensive_strength for unit in defender.village.units.values()])
-        battle.defender_strenght *= models.Village.DEFENSIVE_BONUS
-        battle.attacker_strenght = sum([unit.offensive_strength for unit in battle.attacker_units.values()])
-
-        ratio = min(battle.attacker_strenght, battle.defender_strenght) / max(
-            battle.attacker_strenght, battle.defender_strenght
-        )
-
         count_left_attacker_units = 0
 
-        winner = attacker if battle.attacker_strenght > battle.defender_strenght else defender
-        if winner == attacker:
-            battle.result = models.Battle.BattleResult.WIN
-
-            battle.left_attacker_spearman_count = round(battle.attacker_spearman_count * (1 - ratio))
-            battle.left_attacker_swordsman_count = round(battle.attacker_swordsman_count * (1 - ratio))
-            battle.left_attacker_axeman_count = round(battle.attacker_axeman_count * (1 - ratio))
-            battle.left_attacker_archer_count = round(battle.attacker_archer_count * (1 - ratio))
-
-            battle.attacker_lost_morale = models.Battle.BASE_MORALE_LOSS * ratio * 0.5
-            battle.defender_lost_morale = models.Battle.BASE_MORALE_LOSS * (1 - ratio)
-
-            attacker_capacity = sum([unit.get_carrying_capacity for unit in battle.left_attacker_units.values()])
-
-            battle.plundered_wood = min(defender.village.wood, attacker_capacity)
-            battle.plundered_clay = min(defender.village.clay, attacker_capacity)
-            battle.plundered_iron = min(defender.village.iron, attacker_capacity)
-
-            defender.village.charge_resources(battle.plundered_resources)
-            count_left_attacker_units = sum(map(lambda unit: unit.count, battle.left_attacker_units.values()))
-
-            defender.village.morale -= battle.defender_lost_morale
-
-            attack_time = battle.battle_time - battle.start_time
-            if count_left_attacker_units > 0:
-                battle.phase = models.Battle.BattlePhase.RETURNING
-                battle.return_time = timezone.now() + attack_time / 2
+        with UnitOfWork() as unit_of_work:
+            if not BattleService._finish_phase(battle, models.Battle.BattlePhase.ONGOING):
+                return
+
+            defender.village.update_resources(commit=False)
+            defender.village.update_units(commit=False)
+
+            defender_counts = tuple(unit.count for unit in defender.village.units.values())
+            attacker_counts = tuple(unit.count for unit in battle.attacker_units.values())
+            defender_resources = tuple(getattr(defender.village, name) for name in models.Village.RESOURCE_NAMES)
+            outcome = combat.resolve_battle(attacker_counts, defender_counts, defender_resources)
+
+            battle.attacker_strenght = outcome.attacker_strength
+            battle.defender_strenght = outcome.defender_strength
+            battle.attacker_lost_morale = outcome.attacker_lost_morale
+            battle.defender_lost_morale = outcome.defender_lost_morale
+            for unit_name, count, left_attacker_count, left_defender_count in zip(
+                models.Village.UNIT_NAMES, defender_counts, outcome.left_attacker_counts, outcome.left_defender_counts
+            ):
+                setattr(battle, f"defender_{unit_name}_count", count)
+                setattr(battle, f"left_attacker_{unit_name}_count", left_attacker_count)
+                setattr(battle, f"left_defender_{unit_name}_count", left_defender_count)
+                setattr(defender.village, f"{unit_name}_count", left_defender_count)
+
+            if outcome.is_attacker_winner:
+                battle.result = models.Battle.BattleResult.WIN
+                plundered_resources = defender.village.plunder_resources(
+                    dict(zip(models.Village.RESOURCE_NAMES, outcome.plundered_resources))
+                )
+                for resource_name, amount in plundered_resources.items():
+                    setattr(battle, f"plundered_{resource_name}", amount)
+
+                defender.village.morale -= battle.defender_lost_morale
+
+                count_left_attacker_units = sum(outcome.left_attacker_counts)
+                if count_left_attacker_units > 0:
+                    battle.phase = models.Battle.BattlePhase.RETURNING
+                    battle.return_time = timezone.now() + (battle.battle_time - battle.start_time) / 2
+                else:
+                    battle.phase = models.Battle.BattlePhase.FINISHED
             else:
+                battle.result = models.Battle.BattleResult.LOSE
                 battle.phase = models.Battle.BattlePhase.FINISHED
 
+            unit_of_work.register(battle, defender.village)
+
+        if battle.result == models.Battle.BattleResult.WIN:
             GameSessionConsumerService.inform_player(
                 defender, f"You have lost the defense against {attacker.nickname}!"
             )
         else:
-            battle.result = models.Battle.BattleResult.LOSE
-            battle.phase = models.Battle.BattlePhase.FINISHED
-
-            battle.left_defender_spearman_count = round(battle.defender_spearman_count * (1 - ratio))
-            battle.left_defender_swordsman_count = round(battle.defender_swordsman_count * (1 - ratio))
-            battle.left_defender_axeman_count = round(battle.defender_axeman_count * (1 - ratio))
-            battle.left_defender_archer_count = round(battle.defender_archer_count * (1 - ratio))
-
-            battle.attacker_lost_morale = models.Battle.BASE_MORALE_LOSS * (1 - ratio)
-
             GameSessionConsumerService.inform_player(attacker, f"{defender.nickname} has defended himself!")
             GameSessionConsumerService.inform_player(
                 defender, f"You have successfully defended yourself from {attacker.nickname}!"
             )
 
-        battle.save()
-
-        defender.village.spearman_count = battle.left_defender_spearman_count
-        defender.village.swordsman_count = battle.left_defender_swordsman_count
-        defender.village.axeman_count = battle.left_defender_axeman_count
-        defender.village.archer_count = battle.left_defender_archer_count
-        defender.village.save()
-
         GameSessionConsumerService.send_fetch_units_count(defender)
         GameSessionConsumerService.send_fetch_resources(defender)
         GameSessionConsumerService.send_morale(defender)
-        GameSessionConsumerService.send_battle_log(battle.attacker.game_session)
+        GameSessionConsumerService.send_battle_log_entry(battle)
+        LeaderboardService.update_points(defender)
 
         if count_left_attacker_units > 0:
-            tasks.return_units_task.apply_async((battle.id,), eta=battle.return_time)
+            scheduler.schedule_event(
+                "return_units", battle.id, eta=battle.return_time, game_session_id=battle.game_session_id
+            )
 
     @staticmethod
+    @notifications.batched
     def attacker_return(battle: models.Battle):
-        battle.attacker.village.spearman_count += battle.left_attacker_spearman_count
-        battle.attacker.village.swordsman_count += battle.left_attacker_swordsman_count
-        battle.attacker.village.axeman_count += battle.left_attacker_axeman_count
-        battle.attacker.village.archer_count += battle.left_attacker_archer_count
-        battle.attacker.village.morale -= battle.attacker_lost_morale
-        battle.attacker.village.save()
-
-        battle.attacker.village.add_resources(battle.plundered_resources)
-        battle.attacker.village.update_resources()
+        village = battle.attacker.village
+        with UnitOfWork() as unit_of_work:
+            if not BattleService._finish_phase(battle, models.Battle.BattlePhase.RETURNING):
+                return
+
+            village.update_resources(commit=False)
+            village.spearman_count += battle.left_attacker_spearman_count
+            village.swordsman_count += battle.left_attacker_swordsman_count
+            village.axeman_count += battle.left_attacker_axeman_count
+            village.archer_count += battle.left_attacker_archer_count
+            village.morale -= battle.attacker_lost_morale
+            village.add_resources(battle.plundered_resources)
+            unit_of_work.register(village)
 
         GameSessionConsumerService.inform_player(battle.attacker, "Your units returned from battle!")
         GameSessionConsumerService.send_fetch_units_count(battle.attacker)
         GameSessionConsumerService.send_fetch_resources(battle.attacker)
         GameSessionConsumerService.send_morale(battle.attacker)
+        GameSessionConsumerService.send_battle_log_entry(battle)
+        LeaderboardService.update_points(battle.attacker)
+
+    @staticmethod
+    def _finish_phase(battle: models.Battle, phase: str) -> bool:
+        """
+        Marks the battle as finished if it is still in the given phase, within the transaction of the event.
+        Events may be run more than once (see DatabaseScheduler), False means a previous run has handled it.
+        The phase of a battle which goes on is saved with the rest of the battle.
+        """
+        if not models.Battle.objects.filter(id=battle.id, phase=phase).update(phase=models.Battle.BattlePhase.FINISHED):
+            return False
+
+        battle.phase = models.Battle.BattlePhase.FINISHED
+        return True
+
+
+class BattleLogService:
+    """
+    The battle log of every game session is kept in the cache, as a ring buffer of the Battle.BATTLE_LOG_SIZE
+    most recent serialized battles, newest first. Entries are added when a battle is created and replaced
+    when its phase changes. A missing buffer (expired, evicted or lost on update) is rebuilt from the database.
+
+    Updates are serialized by a lock. A worker which finds the lock taken marks the buffer dirty and drops it,
+    the lock holder drops the buffer it has written as well if it finds the mark, so the entry of the other
+    worker is never lost: the next read rebuilds the buffer from the database.
+    """
+
+    CACHE_TIMEOUT = int((models.GameSession.DURATION * 2).total_seconds())
+    LOCK_TIMEOUT = 5  # seconds
+
+    @staticmethod
+    def get_battle_log(game_session: models.GameSession) -> list[dict]:
+        cache_key = BattleLogService._get_cache_key(game_session.id)
+        battle_log = cache.get(cache_key)
+
+        if battle_log is None:
+            battle_log = serializers.BattleLogSerializer(game_session.battles.battle_log(), many=True).data
+            cache.set(cache_key, battle_log, BattleLogService.CACHE_TIMEOUT)
+
+        return battle_log
+
+    @staticmethod
+    def save_entry(battle: models.Battle) -> dict:
+        """Adds or replaces the entry of the battle in the buffer and returns it."""
+        entry = serializers.BattleLogSerializer(battle).data
+        cache_key = BattleLogService._get_cache_key(battle.game_session_id)
+        lock_key, dirty_key = f"{cache_key}:lock", f"{cache_key}:dirty"
+
+        if not cache.add(lock_key, True, BattleLogService.LOCK_TIMEOUT):
+            # Another worker is updating the buffer, which may be written after this delete from its stale copy
+            cache.set(dirty_key, True, BattleLogService.CACHE_TIMEOUT)
+            cache.delete(cache_key)
+            return entry
+
+        try:
+            battle_log = BattleLogService.get_battle_log(battle.game_session)
+            entry_ids = [logged_entry["id"] for logged_entry in battle_log]
+
+            if entry["id"] in entry_ids:
+                battle_log[entry_ids.index(entry["id"])] = entry
+            else:
+                battle_log = [entry, *battle_log][: models.Battle.BATTLE_LOG_SIZE]
+
+            cache.set(cache_key, battle_log, BattleLogService.CACHE_TIMEOUT)
+            # Another worker has saved an entry meanwhile, which the written buffer may miss
+            if cache.get(dirty_key):
+                cache.delete_many([dirty_key, cache_key])
+        finally:
+            cache.delete(lock_key)
+
+        return entry
+
+    @staticmethod
+    def _get_cache_key(game_session_id) -> str:
+        return f"battle_log:{game_session_id}"
+
+
+class LeaderboardService:
+    """
+    Keeps Village.points up to date from the events changing them: finished upgrades and training,
+    units sent, lost and returned, morale changes. The standings are broadcast at most once per
+    BROADCAST_DELAY, however many points change in between.
+    """
+
+    BROADCAST_DELAY = timedelta(seconds=2)
+
+    @staticmethod
+    def update_points(player: models.Player):
+        player.village.update_resources(commit=False)
+        player.village.update_units(commit=False)
+        points = player.points
+
+        if not models.Village.objects.filter(id=player.village_id).exclude(points=points).update(points=points):
+            return
+
+        # Only the first change since the last broadcast schedules the next one
+        dirty_game_sessions = models.GameSession.objects.filter(id=player.game_session_id, is_leaderboard_dirty=False)
+        if dirty_game_sessions.update(is_leaderboard_dirty=True):
+            scheduler.schedule_event(
+                "broadcast_leaderboard",
+                player.game_session_id,
+                eta=timezone.now() + LeaderboardService.BROADCAST_DELAY,
+                game_session_id=player.game_session_id,
+            )
+
+    @staticmethod
+    def broadcast_leaderboard(game_session: models.GameSession):
+        dirty_game_sessions = models.GameSession.objects.filter(id=game_session.id, is_leaderboard_dirty=True)
+        if not dirty_game_sessions.update(is_leaderboard_dirty=False) or game_session.has_ended:
+            return
+
+        GameSessionConsumerService.send_live_leaderboard(game_session)
 
 
 class CoordinateService:
@@ -437,4 +632,4 @@ class CoordinateService:
             village = player.village
             village.x, village.y = random.choice(tuple(left_coordinates))
             left_coordinates.remove((village.x, village.y))
-            village.save()
+            village.save_dirty_fields()
@@ -1,33 +1,38 @@
-from game import models, services
+from game import models, notifications, services
 from plemiona_api.celery import app
 
 
 @app.task
+@notifications.batched
 def upgrade_building_task(player_id, building_name):
     player = models.Player.objects.get(id=player_id)
 
-    player.village.update_resources()
-    player.village.upgrade_building_level(building_name)
-    player.village.set_building_upgrading_state(building_name, False)
-
-    services.GameSessionConsumerService.send_fetch_buildings(player)
+    # The finished upgrade is applied by update_resources, this task only notifies the player about it
+    services.GameSessionConsumerService.send_fetch_buildings(player, building_names=(building_name,))
     services.GameSessionConsumerService.send_fetch_resources(player)
     services.GameSessionConsumerService.inform_player(
         player, f"{building_name.replace('_', '').title()} has been upgraded"
     )
+    services.LeaderboardService.update_points(player)
 
 
 @app.task
-def end_game_task(game_session_id):
-    game_session = models.GameSession.objects.get(id=game_session_id)
-    services.GameSessionService.end_game_session(game_session)
+@notifications.batched
+def units_trained_task(player_id):
+    player = models.Player.objects.get(id=player_id)
+    services.GameSessionConsumerService.inform_player(player, "Units are ready to be picked up!")
+    services.LeaderboardService.update_points(player)
 
 
 @app.task
-def train_unit_task(player_id, unit_name):
-    player = models.Player.objects.get(id=player_id)
-    player.village.increase_unit_count(unit_name, 1)
-    services.GameSessionConsumerService.send_fetch_units_count(player)
+def broadcast_leaderboard_task(game_session_id):
+    services.LeaderboardService.broadcast_leaderboard(models.GameSession.objects.get(id=game_session_id))
+
+
+@app.task
+def end_game_task(game_session_id):
+    game_session = models.GameSession.objects.get(id=game_session_id)
+    services.GameSessionService.end_game_session(game_session)
 
 
 @app.task
@@ -37,10 +42,7 @@ def attack_task(battle_id):
 
 @app.task
 def return_units_task(battle_id):
-    battle = models.Battle.objects.get(id=battle_id)
-    battle.phase = models.Battle.BattlePhase.FINISHED
-    battle.save()
-    services.BattleService.attacker_return(battle)
+    services.BattleService.attacker_return(models.Battle.objects.get(id=battle_id))
 
 
 @app.task
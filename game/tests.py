@@ -1,9 +1,45 @@
-from django.test import TestCase
+import asyncio
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+import jwt
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from game.models import Player, GameSession
+from game import combat, deltas, exceptions, notifications, scheduler, services, units
+from game.buildings import BUILDINGS, Sawmill, TownHall, Warehouse
+from game.consumers import GameSessionConsumer
+from game.routing import websocket_urlpatterns
+from game.deltas import DeltaStream
+from game.models import Battle, Player, GameSession, Village
+from game.serializers import PlayerResultsSerializer, ResourcesSerializer, UnitsCountInVillageSerializer
+from utils.jwt_authentication import (
+    JWTAuthentication,
+    JwtAuthMiddleware,
+    JwtAuthMiddlewareStack,
+    VerifiedTokenCache,
+    create_session_token,
+    get_session_claims,
+    verified_tokens,
+)
+from utils.unit_of_work import UnitOfWork
+
+LOCAL_MEMORY_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
 
 
 class GameSessionTestCase(TestCase):
@@ -185,3 +221,1084 @@ class GameSessionTestCase(TestCase):
 
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertFalse(game_session.has_started)
+
+
+class VillageTrainingQueueTestCase(TestCase):
+    def test_enqueue_units_chains_batches(self):
+        village = Village.objects.create()
+        finish_training_time = village.enqueue_units([("spearman", 3), ("archer", 0), ("axeman", 2)])
+        village.refresh_from_db()
+
+        self.assertEqual([batch["name"] for batch in village.training_queue], ["spearman", "axeman"])
+        self.assertEqual(village.training_finishes_at, finish_training_time)
+        self.assertEqual(
+            finish_training_time - datetime.fromisoformat(village.training_queue[0]["startedAt"]),
+            units.Spearman.get_training_time(3) + units.Axeman.get_training_time(2),
+        )
+
+    def test_update_units_moves_trained_units_to_barracks(self):
+        village = Village.objects.create()
+        village.enqueue_units([("spearman", 3), ("axeman", 2)])
+
+        # Pretend the spearmen and one axeman have already been trained
+        elapsed = units.Spearman.get_training_time(3) + units.Axeman.get_training_time(1)
+        village.training_queue[0]["startedAt"] = (timezone.now() - elapsed - timedelta(seconds=1)).isoformat()
+        village.training_queue[1]["startedAt"] = (timezone.now() - units.Axeman.get_training_time(1)).isoformat()
+        village.update_units()
+        village.refresh_from_db()
+
+        self.assertEqual(village.spearman_count, 3)
+        self.assertEqual(village.axeman_count, 1)
+        self.assertEqual(len(village.training_queue), 1)
+        self.assertEqual(village.training_queue[0]["name"], "axeman")
+        self.assertEqual(village.training_queue[0]["count"], 1)
+
+    def test_units_serializer_reports_training_progress(self):
+        village = Village.objects.create()
+        finish_training_time = village.enqueue_units([("archer", 4)])
+
+        data = UnitsCountInVillageSerializer(village).data
+
+        self.assertEqual(data["units"]["archer"]["count"], 0)
+        self.assertEqual(data["trainingQueue"][0]["count"], 4)
+        self.assertEqual(data["trainingQueue"][0]["finishesAt"], finish_training_time.isoformat())
+
+    def test_units_serializer_does_not_truncate_training_duration(self):
+        village = Village.objects.create()
+        with mock.patch.object(units.Archer, "TRAINING_TIME", timedelta(seconds=2.5)):
+            village.enqueue_units([("archer", 2)])
+
+        data = UnitsCountInVillageSerializer(village).data
+
+        self.assertEqual(data["trainingQueue"][0]["trainingDuration"], 2.5)
+
+
+class VillageBuildingUpgradeTestCase(TestCase):
+    def test_update_resources_applies_finished_upgrade(self):
+        now = timezone.now()
+        village = Village.objects.create(
+            wood=0,
+            iron=0,
+            clay=0,
+            last_resources_update=now - timedelta(seconds=60),
+            sawmill_upgrade_finishes_at=now - timedelta(seconds=20),
+            clay_pit_upgrade_finishes_at=now + timedelta(seconds=20),
+        )
+
+        village.update_resources()
+        village.refresh_from_db()
+
+        self.assertEqual(village.sawmill_level, 2)
+        self.assertIsNone(village.sawmill_upgrade_finishes_at)
+        self.assertEqual(village.clay_pit_level, 1)
+        self.assertTrue(village.buildings_upgrading_state["clay_pit"])
+
+        # 40 seconds at level 1 and the remaining 20 seconds at level 2
+        expected_wood = Sawmill(level=1).get_production(40) + Sawmill(level=2).get_production(20)
+        self.assertAlmostEqual(village.wood, expected_wood, delta=Sawmill(level=2).get_production(0.5))
+
+
+class SchedulerTestCase(TestCase):
+    @mock.patch("game.services.GameSessionConsumerService.inform_player")
+    def test_database_scheduler_runs_due_events_in_order(self, inform_player):
+        player = Player.objects.create(nickname="test", game_session=GameSession.objects.create())
+        database_scheduler = scheduler.DatabaseScheduler()
+        now = timezone.now()
+
+        database_scheduler.schedule("send_delayed_message", (player.id, "second"), now - timedelta(seconds=1))
+        database_scheduler.schedule("send_delayed_message", (player.id, "first"), now - timedelta(seconds=2))
+        database_scheduler.schedule("send_delayed_message", (player.id, "later"), now + timedelta(minutes=1))
+
+        self.assertEqual(database_scheduler.dispatch_due_events(now), 2)
+        self.assertEqual([call.args[1] for call in inform_player.call_args_list], ["first", "second"])
+        self.assertEqual(scheduler.models.ScheduledEvent.objects.count(), 1)
+
+    def test_database_scheduler_keeps_failed_events(self):
+        database_scheduler = scheduler.DatabaseScheduler()
+        now = timezone.now()
+        # The player does not exist, so the handler raises
+        database_scheduler.schedule("send_delayed_message", (0, "message"), now)
+
+        with self.assertLogs("game.scheduler", level="ERROR"):
+            self.assertEqual(database_scheduler.dispatch_due_events(now), 1)
+
+        event = scheduler.models.ScheduledEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        # Retried once the claim has timed out, then kept for inspection
+        self.assertEqual(database_scheduler.dispatch_due_events(now), 0)
+        for attempt in range(2, database_scheduler.MAX_ATTEMPTS + 1):
+            now += database_scheduler.CLAIM_TIMEOUT
+            with self.assertLogs("game.scheduler", level="ERROR"):
+                self.assertEqual(database_scheduler.dispatch_due_events(now), 1)
+
+        self.assertEqual(database_scheduler.dispatch_due_events(now + database_scheduler.CLAIM_TIMEOUT), 0)
+        self.assertEqual(scheduler.models.ScheduledEvent.objects.get().attempts, database_scheduler.MAX_ATTEMPTS)
+
+    @mock.patch("game.services.GameSessionConsumerService.inform_player")
+    def test_database_scheduler_reclaims_events_of_interrupted_dispatcher(self, inform_player):
+        player = Player.objects.create(nickname="test", game_session=GameSession.objects.create())
+        database_scheduler = scheduler.DatabaseScheduler()
+        now = timezone.now()
+        database_scheduler.schedule("send_delayed_message", (player.id, "message"), now)
+
+        with mock.patch("game.scheduler.run_event", side_effect=SystemExit), self.assertRaises(SystemExit):
+            database_scheduler.dispatch_due_events(now)
+
+        # Still claimed by the dispatcher which died
+        self.assertEqual(database_scheduler.dispatch_due_events(now), 0)
+        self.assertEqual(database_scheduler.dispatch_due_events(now + database_scheduler.CLAIM_TIMEOUT), 1)
+        inform_player.assert_called_once()
+        self.assertFalse(scheduler.models.ScheduledEvent.objects.exists())
+
+    def test_scheduler_rejects_unknown_event(self):
+        with self.assertRaises(ValueError):
+            scheduler.DatabaseScheduler().schedule("unknown", (), timezone.now())
+
+    def test_asyncio_scheduler_runs_events_in_order(self):
+        asyncio_scheduler = scheduler.AsyncioScheduler()
+        now = timezone.now()
+        ran_events = []
+        done = threading.Event()
+
+        def run_event(event_name, args):
+            ran_events.append(args[0])
+            if len(ran_events) == 2:
+                done.set()
+
+        with mock.patch("game.scheduler.run_event", run_event):
+            asyncio_scheduler.schedule("end_game", (2,), now + timedelta(milliseconds=100))
+            asyncio_scheduler.schedule("end_game", (1,), now)
+            self.assertTrue(done.wait(timeout=5))
+
+        self.assertEqual(ran_events, [1, 2])
+
+    def test_asyncio_scheduler_runs_events_one_at_a_time(self):
+        asyncio_scheduler = scheduler.AsyncioScheduler()
+        # Due shortly, so that all events are scheduled before the first one fires
+        eta = timezone.now() + timedelta(milliseconds=200)
+        running, overlaps, ran_events = [], [], []
+        done = threading.Event()
+
+        def run_event(event_name, args):
+            running.append(args[0])
+            overlaps.append(len(running) > 1)
+            time.sleep(0.01)
+            running.remove(args[0])
+            ran_events.append(args[0])
+            if len(ran_events) == 3:
+                done.set()
+
+        with mock.patch("game.scheduler.run_event", run_event):
+            for index in (3, 1, 2):
+                asyncio_scheduler.schedule("end_game", (index,), eta + timedelta(milliseconds=index))
+            self.assertTrue(done.wait(timeout=5))
+
+        self.assertEqual(ran_events, [1, 2, 3])
+        self.assertFalse(any(overlaps))
+
+    @override_settings(GAME_TASK_QUEUES=4)
+    def test_celery_scheduler_routes_game_session_to_one_queue(self):
+        queues = {scheduler.get_game_queue(game_session_id) for game_session_id in range(100)}
+        self.assertEqual(queues, {"game-0", "game-1", "game-2", "game-3"})
+
+        with mock.patch("game.tasks.attack_task.apply_async") as attack, mock.patch(
+            "game.tasks.end_game_task.apply_async"
+        ) as end_game:
+            scheduler.CeleryScheduler().schedule("attack", (1,), timezone.now(), game_session_id=7)
+            scheduler.CeleryScheduler().schedule("end_game", (7,), timezone.now(), game_session_id=7)
+
+        self.assertEqual(attack.call_args.kwargs["queue"], scheduler.get_game_queue(7))
+        self.assertEqual(end_game.call_args.kwargs["queue"], scheduler.get_game_queue(7))
+
+
+class BuildingTablesTestCase(TestCase):
+    def test_tables_match_formulas(self):
+        for building_class in BUILDINGS.values():
+            for level in range(1, building_class.MAX_LEVEL + 1):
+                building = building_class(level=level)
+                self.assertEqual(
+                    building.get_upgrade_cost()["wood"],
+                    round(building_class.WOOD_COST_FACTOR * math.exp(level * building_class.COST_COEFF) / 10) * 10,
+                )
+                self.assertEqual(
+                    building.get_upgrade_time(town_hall_level=3),
+                    (
+                        building_class.BASE_UPGRADE_TIME
+                        * (building_class.UPGRADE_TIME_FACTOR**level)
+                        * (TownHall.UPGRADE_TIME_DISCOUNT**-3)
+                    ).total_seconds(),
+                )
+
+        self.assertEqual(Warehouse(level=4).get_capacity(), round(813 * math.exp(4 * 0.23) / 100) * 100)
+        self.assertEqual(Sawmill(level=4).get_production(60), 51.614 * math.exp(4 * 0.15))
+
+    def test_tables_are_immutable(self):
+        with self.assertRaises(TypeError):
+            Warehouse.UPGRADE_COSTS[1]["wood"] = 0
+
+        cost = Warehouse(level=1).get_upgrade_cost()
+        cost["wood"] = 0
+        self.assertNotEqual(Warehouse(level=1).get_upgrade_cost()["wood"], 0)
+
+
+class GameDataTestCase(TestCase):
+    def test_game_data_contains_unit_and_building_stats(self):
+        response = self.client.get(reverse("game:game_data"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["units"]["spearman"]["speed"], units.Spearman.SPEED.total_seconds())
+        self.assertEqual(len(response.data["buildings"]["warehouse"]["capacities"]), Warehouse.MAX_LEVEL)
+        self.assertEqual(response.headers["ETag"], f'"{response.data["version"]}"')
+        self.assertIn("no-cache", response.headers["Cache-Control"])
+
+    def test_game_data_not_modified(self):
+        etag = self.client.get(reverse("game:game_data")).headers["ETag"]
+        response = self.client.get(reverse("game:game_data"), headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class DeltaStreamTestCase(TestCase):
+    def test_full_snapshots_until_acknowledged(self):
+        stream = DeltaStream("fetch_buildings")
+
+        first = stream.encode({"buildings": {"sawmill": {"level": 1}, "warehouse": {"level": 1}}})
+        second = stream.encode({"buildings": {"sawmill": {"level": 2}}})
+
+        self.assertEqual(first["type"], "fetch_buildings")
+        self.assertEqual(second["type"], "fetch_buildings")
+        self.assertEqual(second["data"], {"buildings": {"sawmill": {"level": 2}, "warehouse": {"level": 1}}})
+
+    def test_deltas_against_acknowledged_version(self):
+        stream = DeltaStream("fetch_buildings")
+        stream.acknowledge(
+            stream.encode({"buildings": {"sawmill": {"level": 1}, "warehouse": {"level": 1}}})["version"]
+        )
+
+        message = stream.encode({"buildings": {"sawmill": {"level": 2}, "warehouse": {"level": 1}}})
+
+        self.assertEqual(message["type"], "fetch_buildings_delta")
+        self.assertEqual(message["baseVersion"], 1)
+        self.assertEqual(message["data"], {"buildings": {"sawmill": {"level": 2}}})
+        self.assertIsNone(stream.encode({"buildings": {"sawmill": {"level": 2}}}))
+        self.assertEqual(stream.encode({}, full=True)["type"], "fetch_buildings")
+
+    def test_merge_inverts_diff(self):
+        old = {"resources": {"wood": 1, "clay": 2}, "queue": [1], "removed": 1}
+        new = {"resources": {"wood": 3, "clay": 2}, "queue": [1, 2]}
+
+        self.assertEqual(deltas.merge(old, deltas.diff(old, new)), {**new, "removed": None})
+
+
+class ResourcesProtocolTestCase(TestCase):
+    def test_reading_resources_does_not_write(self):
+        village = Village.objects.create(
+            last_resources_update=timezone.now() - timedelta(minutes=5),
+            warehouse_upgrade_finishes_at=timezone.now() - timedelta(minutes=1),
+        )
+
+        with self.assertNumQueries(0):
+            village.update_resources(commit=False)
+            data = ResourcesSerializer(village).data
+
+        self.assertEqual(data["asOf"], village.last_resources_update.isoformat())
+        self.assertEqual(data["resourcesIncome"]["wood"], village.sawmill.get_production())
+        self.assertEqual(data["resourcesCapacity"], Warehouse(level=2).get_capacity())
+
+    def test_project_resources_leaves_village_untouched(self):
+        last_resources_update = timezone.now() - timedelta(minutes=5)
+        village = Village.objects.create(wood=0, iron=0, clay=0, last_resources_update=last_resources_update)
+
+        resources = village.project_resources(last_resources_update + timedelta(seconds=30))
+
+        self.assertAlmostEqual(resources["wood"], Sawmill(level=1).get_production(30))
+        self.assertEqual(village.wood, 0)
+        self.assertEqual(village.last_resources_update, last_resources_update)
+
+
+class ResourcesChargeTestCase(TestCase):
+    def test_charge_is_a_single_update(self):
+        village = Village.objects.create(wood=500, iron=500, clay=500, last_resources_update=timezone.now())
+
+        with self.assertNumQueries(1):
+            village.charge_resources({"wood": 100, "iron": 200, "clay": 300})
+
+        stored_village = Village.objects.get(id=village.id)
+        self.assertAlmostEqual(stored_village.wood, village.wood)
+        self.assertAlmostEqual(stored_village.clay, village.clay)
+        self.assertGreaterEqual(stored_village.clay, 200)
+        self.assertLess(stored_village.clay, 201)
+        self.assertEqual(stored_village.last_resources_update, village.last_resources_update)
+
+    def test_charge_settles_finished_upgrades(self):
+        village = Village.objects.create(
+            wood=500,
+            iron=500,
+            clay=500,
+            last_resources_update=timezone.now() - timedelta(minutes=1),
+            sawmill_upgrade_finishes_at=timezone.now() - timedelta(seconds=30),
+        )
+
+        village.charge_resources({"wood": 100, "iron": 100, "clay": 100})
+        village.refresh_from_db()
+
+        self.assertEqual(village.sawmill_level, 2)
+        self.assertIsNone(village.sawmill_upgrade_finishes_at)
+
+    def test_insufficient_resources(self):
+        village = Village.objects.create(wood=50, iron=500, clay=500, last_resources_update=timezone.now())
+
+        with self.assertRaises(exceptions.InsufficientResourcesException):
+            village.charge_resources({"wood": 100, "iron": 100, "clay": 100})
+
+        self.assertEqual(Village.objects.get(id=village.id).iron, 500)
+
+    def test_concurrent_charges_do_not_overwrite_each_other(self):
+        village = Village.objects.create(wood=250, iron=250, clay=250, last_resources_update=timezone.now())
+        first_copy = Village.objects.get(id=village.id)
+        second_copy = Village.objects.get(id=village.id)
+
+        first_copy.charge_resources({"wood": 100, "iron": 100, "clay": 100})
+        second_copy.charge_resources({"wood": 100, "iron": 100, "clay": 100})
+
+        with self.assertRaises(exceptions.InsufficientResourcesException):
+            village.charge_resources({"wood": 100, "iron": 100, "clay": 100})
+
+        self.assertLess(Village.objects.get(id=village.id).wood, 51)
+
+    def test_add_resources_is_capped_by_warehouse(self):
+        village = Village.objects.create(wood=0, iron=0, clay=0, last_resources_update=timezone.now())
+        concurrent_copy = Village.objects.get(id=village.id)
+
+        village.add_resources({"wood": 10**9, "iron": 0, "clay": 0})
+        concurrent_copy.add_resources({"wood": 0, "iron": 100, "clay": 0})
+        village.refresh_from_db()
+
+        self.assertEqual(village.wood, village.warehouse.get_capacity())
+        self.assertGreaterEqual(village.iron, 100)
+
+    def test_plunder_is_clamped_to_resources_left(self):
+        village = Village.objects.create(wood=300, iron=300, clay=300, last_resources_update=timezone.now())
+        concurrent_copy = Village.objects.get(id=village.id)
+
+        concurrent_copy.charge_resources({"wood": 250, "iron": 0, "clay": 0})
+        plundered_resources = village.plunder_resources({"wood": 100, "iron": 100, "clay": 100})
+
+        self.assertGreaterEqual(plundered_resources["wood"], 50)
+        self.assertLess(plundered_resources["wood"], 51)
+        self.assertEqual(plundered_resources["iron"], 100)
+        stored_village = Village.objects.get(id=village.id)
+        self.assertEqual(stored_village.wood, 0)
+        self.assertAlmostEqual(stored_village.iron, village.iron)
+
+
+class UnitOfWorkTestCase(TestCase):
+    def test_only_dirty_fields_are_written(self):
+        village = Village.objects.create(last_resources_update=timezone.now() - timedelta(minutes=1))
+        village = Village.objects.get(id=village.id)
+
+        with CaptureQueriesContext(connection) as context:
+            with UnitOfWork() as unit_of_work:
+                village.update_resources(commit=False)
+                village.morale -= 10
+                unit_of_work.register(village)
+
+        updates = [query["sql"] for query in context.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"morale"', updates[0])
+        # The settlement alone is not written, the stored state projects to the same resources
+        self.assertNotIn('"wood"', updates[0])
+
+    def test_registered_fields_are_written_even_if_unchanged(self):
+        village = Village.objects.create(last_resources_update=timezone.now() - timedelta(minutes=1))
+        village = Village.objects.get(id=village.id)
+
+        with CaptureQueriesContext(connection) as context:
+            with UnitOfWork() as unit_of_work:
+                village.update_resources(commit=False)
+                unit_of_work.register(village, fields=Village.SETTLED_FIELDS)
+
+        updates = [query["sql"] for query in context.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"wood"', updates[0])
+        self.assertEqual(Village.objects.get(id=village.id).wood, village.wood)
+
+    @mock.patch("game.services.GameSessionConsumerService._send_message")
+    def test_ended_game_session_saves_each_village_once(self, send_message):
+        game_session = GameSession.objects.create(has_started=True, ended_at=timezone.now())
+        player = Player.objects.create(game_session=game_session, nickname="player")
+        Village.objects.filter(id=player.village_id).update(
+            last_resources_update=timezone.now() - timedelta(minutes=1),
+            barracks_upgrade_finishes_at=timezone.now() - timedelta(seconds=1),
+            training_queue=[
+                {
+                    "name": "spearman",
+                    "count": 2,
+                    "startedAt": (timezone.now() - timedelta(minutes=1)).isoformat(),
+                    "trainingTime": units.Spearman.TRAINING_TIME.total_seconds(),
+                }
+            ],
+        )
+
+        with CaptureQueriesContext(connection) as context:
+            services.GameSessionService.end_game_session(game_session)
+
+        updates = [query["sql"] for query in context.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        village = Village.objects.get(id=player.village_id)
+        self.assertEqual((village.barracks_level, village.spearman_count), (2, 2))
+
+    def test_in_place_changes_are_dirty(self):
+        village = Village.objects.get(id=Village.objects.create().id)
+
+        village.training_queue.append({"name": "spearman", "count": 1})
+
+        self.assertEqual(village.get_dirty_fields(), ["training_queue"])
+
+    def test_nothing_is_written_if_the_command_fails(self):
+        village = Village.objects.create(morale=50)
+
+        with self.assertRaises(exceptions.InsufficientResourcesException):
+            with UnitOfWork() as unit_of_work:
+                village.morale = 40
+                unit_of_work.register(village)
+                raise exceptions.InsufficientResourcesException
+
+        self.assertEqual(Village.objects.get(id=village.id).morale, 50)
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class GameSessionConsumerStateTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.game_session = GameSession.objects.create(has_started=True, ended_at=timezone.now() + GameSession.DURATION)
+        self.player = Player.objects.create(game_session=self.game_session, nickname="player")
+        self.consumer = GameSessionConsumer()
+        self.consumer.player = Player.objects.get(id=self.player.id)
+        self.consumer.player_id = str(self.player.id)
+        self.consumer.send_json = mock.AsyncMock()
+
+    def test_connection_state_is_loaded_with_three_queries(self):
+        Player.objects.create(game_session=self.game_session, nickname="defender")
+        Battle.objects.create(
+            game_session=self.game_session,
+            attacker=self.player,
+            defender=Player.objects.get(nickname="defender"),
+            battle_time=timezone.now(),
+        )
+
+        # The player with village and session, the roster and the battle log
+        with self.assertNumQueries(3):
+            state = async_to_sync(self.consumer.load_connection_state)()
+
+        self.assertEqual(len(state["players"]), 2)
+        self.assertEqual(len(state["battle_log"]["battleLog"]), 1)
+        self.assertIn("resources", state["fetch_resources"])
+
+    def test_commands_do_not_reload_game_session(self):
+        async_to_sync(self.consumer.load_connection_state)()
+
+        with self.assertNumQueries(1):
+            async_to_sync(self.consumer.receive_json)({"type": "fetch_resources"})
+
+        self.assertEqual(self.consumer.send_json.call_args.args[0]["type"], "fetch_resources")
+
+    def test_game_session_state_follows_messages(self):
+        ended_at = timezone.now() + GameSession.DURATION
+        start_message = {"type": "start_game_session", "data": {"players": [], "endedAt": ended_at.isoformat()}}
+
+        async_to_sync(self.consumer.send_message)({"type": "send_message", "data": start_message})
+
+        self.assertTrue(self.consumer.has_game_session_started)
+        self.assertFalse(self.consumer.has_game_session_ended)
+
+        leaderboard_message = {"type": "fetch_leaderboard", "data": {"leaderboard": []}}
+        async_to_sync(self.consumer.send_message)({"type": "send_message", "data": leaderboard_message})
+
+        self.assertTrue(self.consumer.has_game_session_ended)
+        with self.assertNumQueries(0):
+            async_to_sync(self.consumer.receive_json)({"type": "fetch_resources"})
+
+    def test_groups_are_joined_from_session_claims(self):
+        consumer = GameSessionConsumer()
+        consumer.scope = {"session_claims": get_session_claims(self.player)}
+        consumer.channel_name = "consumer"
+        consumer.channel_layer = mock.AsyncMock()
+        consumer.accept = mock.AsyncMock()
+        consumer.send_json = mock.AsyncMock()
+
+        load = consumer.load_connection_state
+
+        async def load_connection_state():
+            # Nothing is loaded before the groups are joined
+            self.assertEqual(consumer.channel_layer.group_add.await_count, 2)
+            return await load()
+
+        consumer.load_connection_state = load_connection_state
+        async_to_sync(consumer.connect)()
+
+        consumer.channel_layer.group_add.assert_has_awaits(
+            [mock.call(self.game_session.game_code, "consumer"), mock.call(str(self.player.channel_name), "consumer")]
+        )
+        consumer.accept.assert_awaited_once()
+        self.assertEqual(consumer.player.id, self.player.id)
+
+    def test_middleware_reads_session_claims_without_queries(self):
+        token = create_session_token(self.player)
+        inner = mock.AsyncMock()
+        scope = {"type": "websocket", "query_string": f"token={token}".encode()}
+
+        with self.assertNumQueries(0):
+            async_to_sync(JwtAuthMiddleware(inner))(scope, None, None)
+
+        session_claims = inner.call_args.args[0]["session_claims"]
+        self.assertEqual(session_claims["game_code"], self.game_session.game_code)
+        self.assertEqual(session_claims["channel_name"], str(self.player.channel_name))
+        self.assertEqual(session_claims["game_session_id"], self.game_session.id)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class GameSessionConsumerConnectTestCase(TestCase):
+    """Connects through the middleware stack of plemiona_api.asgi."""
+
+    def setUp(self):
+        self.game_session = GameSession.objects.create()
+        self.player = Player.objects.create(game_session=self.game_session, nickname="player")
+
+    def connect(self, query_string=""):
+        async def connect():
+            application = JwtAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+            communicator = WebsocketCommunicator(application, f"ws/?{query_string}")
+            connected, _ = await communicator.connect()
+            message = await communicator.receive_json_from() if connected else None
+            await communicator.disconnect()
+            return connected, message
+
+        return async_to_sync(connect)()
+
+    def test_connect_with_session_token(self):
+        connected, message = self.connect(f"token={create_session_token(self.player)}")
+
+        self.assertTrue(connected)
+        self.assertEqual(message["type"], "players_list")
+
+    def test_connect_with_token_without_session_claims(self):
+        connected, message = self.connect(f"token={RefreshToken.for_user(self.player).access_token}")
+
+        self.assertTrue(connected)
+        self.assertEqual(message["type"], "players_list")
+
+    def test_connect_without_token_is_rejected(self):
+        connected, _ = self.connect()
+
+        self.assertFalse(connected)
+
+    def test_connect_of_removed_player_is_rejected(self):
+        token = create_session_token(self.player)
+        Player.objects.filter(id=self.player.id).delete()
+
+        connected, _ = self.connect(f"token={token}")
+
+        self.assertFalse(connected)
+
+
+class LeaderboardTestCase(TestCase):
+    def test_points_annotation_matches_player_points(self):
+        game_session = GameSession.objects.create()
+        for index in range(5):
+            player = Player.objects.create(game_session=game_session, nickname=f"player{index}")
+            Village.objects.filter(id=player.village_id).update(
+                morale=random.randint(0, Village.MAX_MORALE),
+                **{f"{name}_level": random.randint(1, BUILDINGS[name].MAX_LEVEL) for name in Village.BUILDING_NAMES},
+                **{field: random.randint(0, 100) for field in Village.UNIT_COUNT_FIELDS},
+            )
+
+        for player in Player.objects.with_points():
+            self.assertEqual(player.total_points, player.points)
+
+    def test_leaderboard_is_a_single_ordered_query(self):
+        game_session = GameSession.objects.create()
+        for index, spearman_count in enumerate((10, 30, 20)):
+            player = Player.objects.create(game_session=game_session, nickname=f"player{index}")
+            Village.objects.filter(id=player.village_id).update(spearman_count=spearman_count)
+
+        with self.assertNumQueries(1):
+            leaderboard = PlayerResultsSerializer(game_session.player_set.leaderboard(), many=True).data
+
+        self.assertEqual([player["nickname"] for player in leaderboard], ["player1", "player2", "player0"])
+
+    @mock.patch("game.services.GameSessionConsumerService._send_message")
+    @mock.patch("game.scheduler.schedule_event")
+    def test_live_leaderboard_broadcasts_are_coalesced(self, schedule_event, send_message):
+        game_session = GameSession.objects.create(has_started=True, ended_at=timezone.now() + GameSession.DURATION)
+        first_player = Player.objects.create(game_session=game_session, nickname="first")
+        second_player = Player.objects.create(game_session=game_session, nickname="second")
+
+        for player, spearman_count in ((first_player, 10), (second_player, 20), (first_player, 30)):
+            player.village.spearman_count = spearman_count
+            services.LeaderboardService.update_points(player)
+
+        self.assertEqual(schedule_event.call_count, 1)
+        self.assertEqual(Village.objects.get(id=first_player.village_id).points, first_player.points)
+
+        services.LeaderboardService.broadcast_leaderboard(game_session)
+        services.LeaderboardService.broadcast_leaderboard(game_session)
+
+        self.assertEqual(send_message.call_count, 1)
+        leaderboard = send_message.call_args.args[1]["data"]["leaderboard"]
+        self.assertEqual([player["nickname"] for player in leaderboard], ["first", "second"])
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class BattleLogTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.game_session = GameSession.objects.create()
+        self.players = [
+            Player.objects.create(game_session=self.game_session, nickname=f"player{index}") for index in range(4)
+        ]
+
+    def create_battle(self, index):
+        return Battle.objects.create(
+            game_session=self.game_session,
+            attacker=self.players[index % 4],
+            defender=self.players[(index + 1) % 4],
+            battle_time=timezone.now(),
+        )
+
+    def test_battle_log_is_loaded_with_a_single_query_then_cached(self):
+        for index in range(Battle.BATTLE_LOG_SIZE + 2):
+            self.create_battle(index)
+
+        with self.assertNumQueries(1):
+            battle_log = services.BattleLogService.get_battle_log(self.game_session)
+        with self.assertNumQueries(0):
+            self.assertEqual(services.BattleLogService.get_battle_log(self.game_session), battle_log)
+
+        self.assertEqual(len(battle_log), Battle.BATTLE_LOG_SIZE)
+        self.assertEqual(battle_log[0]["attacker"]["village"], {"x": 0, "y": 0})
+
+    @mock.patch("game.services.GameSessionConsumerService._send_message")
+    def test_only_new_and_changed_entries_are_sent(self, send_message):
+        battles = [self.create_battle(index) for index in range(Battle.BATTLE_LOG_SIZE)]
+        services.BattleLogService.get_battle_log(self.game_session)
+
+        new_battle = self.create_battle(Battle.BATTLE_LOG_SIZE)
+        services.GameSessionConsumerService.send_battle_log_entry(new_battle)
+        battles[-1].phase = Battle.BattlePhase.FINISHED
+        services.GameSessionConsumerService.send_battle_log_entry(battles[-1])
+
+        sent_entries = [call.args[1]["data"] for call in send_message.call_args_list]
+        self.assertEqual([entry["id"] for entry in sent_entries], [new_battle.id, battles[-1].id])
+
+        battle_log = services.BattleLogService.get_battle_log(self.game_session)
+        self.assertEqual(len(battle_log), Battle.BATTLE_LOG_SIZE)
+        self.assertEqual(battle_log[0]["id"], new_battle.id)
+        self.assertEqual(battle_log[1]["phase"], Battle.BattlePhase.FINISHED)
+        self.assertNotIn(battles[0].id, [entry["id"] for entry in battle_log])
+
+    def test_entry_saved_while_buffer_is_locked_is_not_lost(self):
+        first_battle = self.create_battle(0)
+        services.BattleLogService.get_battle_log(self.game_session)
+        second_battle = self.create_battle(1)
+        get_battle_log = services.BattleLogService.get_battle_log
+
+        def get_battle_log_while_other_worker_saves(game_session):
+            battle_log = get_battle_log(game_session)
+            # The second worker finds the lock taken by the first one, which has read the buffer already
+            services.BattleLogService.save_entry(second_battle)
+            return battle_log
+
+        with mock.patch.object(
+            services.BattleLogService, "get_battle_log", side_effect=get_battle_log_while_other_worker_saves
+        ):
+            services.BattleLogService.save_entry(first_battle)
+
+        battle_log = services.BattleLogService.get_battle_log(self.game_session)
+        self.assertEqual({entry["id"] for entry in battle_log}, {first_battle.id, second_battle.id})
+
+
+@mock.patch("game.notifications.get_channel_layer")
+class NotificationBatchTestCase(TestCase):
+    def test_messages_are_merged_per_group(self, get_channel_layer):
+        group_send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+
+        with self.captureOnCommitCallbacks(execute=True), notifications.NotificationBatch():
+            notifications.send("player", {"type": "fetch_units", "data": {}})
+            with notifications.NotificationBatch():
+                notifications.send("player", {"type": "message", "data": {"message": "hello"}})
+            notifications.send("game", {"type": "battle_log_entry", "data": {}})
+            group_send.assert_not_called()
+
+        notifications.get_publisher().wait_until_sent(timeout=5)
+        events = {call.args[0]: call.args[1] for call in group_send.call_args_list}
+        self.assertEqual(group_send.call_count, 2)
+        self.assertEqual(events["player"]["type"], "send_messages")
+        self.assertEqual([message["type"] for message in events["player"]["data"]], ["fetch_units", "message"])
+        self.assertEqual(events["game"], {"type": "send_message", "data": {"type": "battle_log_entry", "data": {}}})
+
+    def test_messages_are_sent_on_commit(self, get_channel_layer):
+        group_send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic(), notifications.NotificationBatch():
+                notifications.send("player", {"type": "message", "data": {}})
+
+            group_send.assert_not_called()
+
+        notifications.get_publisher().wait_until_sent(timeout=5)
+        group_send.assert_called_once()
+
+    def test_messages_of_failed_command_are_dropped(self, get_channel_layer):
+        group_send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+
+        with self.assertRaises(exceptions.InsufficientResourcesException):
+            with notifications.NotificationBatch():
+                notifications.send("player", {"type": "message", "data": {}})
+                raise exceptions.InsufficientResourcesException
+
+        notifications.get_publisher().wait_until_sent(timeout=5)
+        group_send.assert_not_called()
+
+    def test_publisher_keeps_the_order_of_messages(self, get_channel_layer):
+        sent_messages = []
+
+        async def group_send(group, event):
+            messages = event["data"] if event["type"] == "send_messages" else [event["data"]]
+            await asyncio.sleep(0.01 if messages[0]["data"]["index"] % 2 else 0)
+            sent_messages.extend(message["data"]["index"] for message in messages)
+
+        get_channel_layer.return_value.group_send = group_send
+        publisher = notifications.Publisher()
+
+        for index in range(5):
+            publisher.publish({"player": [{"type": "message", "data": {"index": index}}]})
+        publisher.wait_until_sent(timeout=5)
+
+        self.assertEqual(sent_messages, [0, 1, 2, 3, 4])
+
+    def test_publisher_merges_queued_batches(self, get_channel_layer):
+        group_send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+        publisher = notifications.Publisher()
+
+        # Queued while the loop is busy, so the worker finds all of them at once
+        publisher._event_loop.call_soon(time.sleep, 0.05)
+        for index in range(3):
+            publisher.publish({"player": [{"type": "message", "data": {"index": index}}], "game": [{"index": index}]})
+        publisher.wait_until_sent(timeout=5)
+
+        events = {call.args[0]: call.args[1] for call in group_send.call_args_list}
+        self.assertEqual(group_send.call_count, 2)
+        self.assertEqual([message["data"]["index"] for message in events["player"]["data"]], [0, 1, 2])
+        self.assertEqual(events["game"], {"type": "send_messages", "data": [{"index": 0}, {"index": 1}, {"index": 2}]})
+
+    def test_message_outside_batch_waits_for_commit(self, get_channel_layer):
+        group_send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    notifications.send("player", {"type": "message", "data": {}})
+                    raise exceptions.InsufficientResourcesException
+            except exceptions.InsufficientResourcesException:
+                pass
+
+            with transaction.atomic():
+                notifications.send("player", {"type": "fetch_units", "data": {}})
+                group_send.assert_not_called()
+
+        notifications.get_publisher().wait_until_sent(timeout=5)
+        group_send.assert_called_once_with(
+            "player", {"type": "send_message", "data": {"type": "fetch_units", "data": {}}}
+        )
+
+    def test_consumer_sends_batch_in_one_frame(self, get_channel_layer):
+        consumer = GameSessionConsumer()
+        consumer.send_json = mock.AsyncMock()
+        messages = [{"type": "message", "data": {"message": "hello"}}, {"type": "fetch_units", "data": {"units": {}}}]
+
+        async_to_sync(consumer.send_messages)({"type": "send_messages", "data": messages})
+
+        consumer.send_json.assert_called_once()
+        frame = consumer.send_json.call_args.args[0]
+        self.assertEqual(frame["type"], "batch")
+        self.assertEqual([message["type"] for message in frame["data"]], ["message", "fetch_units"])
+
+
+class JWTAuthenticationTestCase(TestCase):
+    def setUp(self):
+        verified_tokens.clear()
+
+    def get_request(self, token):
+        return RequestFactory().get("/", headers={"Authorization": f"Bearer {token}"})
+
+    def test_player_is_loaded_with_village_and_game_session(self):
+        game_session = GameSession.objects.create()
+        player = Player.objects.create(game_session=game_session, nickname="player")
+        request = self.get_request(RefreshToken.for_user(player).access_token)
+
+        with self.assertNumQueries(1):
+            authenticated_player, payload = JWTAuthentication().authenticate(request)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(authenticated_player.village.id, player.village_id)
+            self.assertEqual(authenticated_player.game_session.id, game_session.id)
+        self.assertEqual(payload["player_id"], str(player.id))
+
+    def test_token_is_decoded_once(self):
+        player = Player.objects.create(game_session=GameSession.objects.create(), nickname="player")
+        request = self.get_request(RefreshToken.for_user(player).access_token)
+
+        with mock.patch("utils.jwt_authentication.jwt.decode", wraps=jwt.decode) as decode:
+            JWTAuthentication().authenticate(request)
+            JWTAuthentication().authenticate(request)
+
+        decode.assert_called_once()
+
+    def test_verified_token_cache_is_bounded_and_expires(self):
+        tokens = VerifiedTokenCache(max_size=2, ttl=60)
+        for token in ("first", "second", "third"):
+            tokens.set(token, {"player_id": 1})
+        tokens.set("expired", {"player_id": 1, "exp": time.time() - 1})
+
+        self.assertIsNone(tokens.get("first"))
+        self.assertIsNone(tokens.get("second"))
+        self.assertEqual(tokens.get("third"), {"player_id": 1})
+        self.assertIsNone(tokens.get("expired"))
+
+
+def resolve_battle_as_before(attacker_counts, defender_counts, defender_resources):
+    """The combat math of BattleService.battle_phase before game/combat.py, kept as the reference."""
+    attacker_units = [units.UNITS[name](count) for name, count in zip(Village.UNIT_NAMES, attacker_counts)]
+    defender_units = [units.UNITS[name](count) for name, count in zip(Village.UNIT_NAMES, defender_counts)]
+    resources = dict(zip(Village.RESOURCE_NAMES, defender_resources))
+    left_attacker_counts, left_defender_counts = [0] * 4, [0] * 4
+    defender_lost_morale, plundered = 0, (0, 0, 0)
+
+    defender_strength = 1 + sum([unit.defensive_strength for unit in defender_units])
+    defender_strength *= Village.DEFENSIVE_BONUS
+    attacker_strength = sum([unit.offensive_strength for unit in attacker_units])
+    ratio = min(attacker_strength, defender_strength) / max(attacker_strength, defender_strength)
+
+    if attacker_strength > defender_strength:
+        left_attacker_counts = [round(count * (1 - ratio)) for count in attacker_counts]
+        attacker_lost_morale = Battle.BASE_MORALE_LOSS * ratio * 0.5
+        defender_lost_morale = Battle.BASE_MORALE_LOSS * (1 - ratio)
+        left_attacker_units = [
+            units.UNITS[name](count) for name, count in zip(Village.UNIT_NAMES, left_attacker_counts)
+        ]
+        capacity = sum([unit.get_carrying_capacity for unit in left_attacker_units])
+        plundered = tuple(min(resources[name], capacity) for name in Village.RESOURCE_NAMES)
+    else:
+        left_defender_counts = [round(count * (1 - ratio)) for count in defender_counts]
+        attacker_lost_morale = Battle.BASE_MORALE_LOSS * (1 - ratio)
+
+    return (
+        attacker_strength > defender_strength,
+        attacker_strength,
+        defender_strength,
+        tuple(left_attacker_counts),
+        tuple(left_defender_counts),
+        attacker_lost_morale,
+        defender_lost_morale,
+        plundered,
+    )
+
+
+class CombatTestCase(TestCase):
+    def get_random_battle(self, generator):
+        max_count = generator.choice((0, 5, 50, 500))
+        return (
+            tuple(generator.randint(0, max_count) for _ in Village.UNIT_NAMES),
+            tuple(generator.randint(0, max_count) for _ in Village.UNIT_NAMES),
+            tuple(generator.uniform(0, 5000) for _ in Village.RESOURCE_NAMES),
+        )
+
+    def test_kernel_matches_previous_battle_phase(self):
+        generator = random.Random(24)
+        battles = [self.get_random_battle(generator) for _ in range(2000)]
+        # Even and empty sides
+        battles += [((0, 0, 0, 0), (0, 0, 0, 0), (100, 100, 100)), ((3, 0, 0, 0), (2, 0, 0, 0), (10, 20, 30))]
+
+        for battle, outcome in zip(battles, combat.resolve_battles(battles)):
+            self.assertEqual(tuple(outcome), resolve_battle_as_before(*battle), battle)
+
+    def test_outcome_invariants(self):
+        generator = random.Random(42)
+        for _ in range(500):
+            attacker_counts, defender_counts, resources = self.get_random_battle(generator)
+            outcome = combat.resolve_battle(attacker_counts, defender_counts, resources)
+
+            for left_counts, counts in (
+                (outcome.left_attacker_counts, attacker_counts),
+                (outcome.left_defender_counts, defender_counts),
+            ):
+                self.assertTrue(all(0 <= left <= count for left, count in zip(left_counts, counts)))
+            self.assertTrue(
+                all(0 <= plundered <= amount for plundered, amount in zip(outcome.plundered_resources, resources))
+            )
+            self.assertTrue(0 <= outcome.attacker_lost_morale <= Battle.BASE_MORALE_LOSS)
+            self.assertTrue(0 <= outcome.defender_lost_morale <= Battle.BASE_MORALE_LOSS)
+            if not outcome.is_attacker_winner:
+                self.assertEqual(outcome.plundered_resources, (0, 0, 0))
+
+    @override_settings(CACHES=LOCAL_MEMORY_CACHES)
+    @mock.patch("game.services.GameSessionConsumerService._send_message")
+    @mock.patch("game.scheduler.schedule_event")
+    def test_battle_phase_applies_outcome(self, schedule_event, send_message):
+        cache.clear()
+        game_session = GameSession.objects.create(has_started=True, ended_at=timezone.now() + GameSession.DURATION)
+        attacker = Player.objects.create(game_session=game_session, nickname="attacker")
+        defender = Player.objects.create(game_session=game_session, nickname="defender")
+        Village.objects.filter(id=defender.village_id).update(spearman_count=5, archer_count=2)
+        now = timezone.now()
+        battle = Battle.objects.create(
+            game_session=game_session,
+            attacker=attacker,
+            defender=defender,
+            attacker_axeman_count=30,
+            start_time=now - timedelta(seconds=10),
+            battle_time=now,
+        )
+        defender_village = Village.objects.get(id=defender.village_id)
+        defender_village.update_resources(commit=False)
+        resources = tuple(getattr(defender_village, name) for name in Village.RESOURCE_NAMES)
+        outcome = combat.resolve_battle((0, 0, 30, 0), (5, 0, 0, 2), resources)
+
+        services.BattleService.battle_phase(Battle.objects.get(id=battle.id))
+
+        battle.refresh_from_db()
+        defender_village.refresh_from_db()
+        self.assertTrue(outcome.is_attacker_winner)
+        self.assertEqual(battle.result, Battle.BattleResult.WIN)
+        self.assertEqual(battle.phase, Battle.BattlePhase.RETURNING)
+        self.assertEqual(battle.left_attacker_axeman_count, outcome.left_attacker_counts[2])
+        self.assertEqual((battle.defender_spearman_count, battle.defender_archer_count), (5, 2))
+        self.assertEqual((defender_village.spearman_count, defender_village.archer_count), (0, 0))
+        self.assertEqual(schedule_event.call_args.args[:2], ("return_units", battle.id))
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+@mock.patch("game.services.GameSessionConsumerService._send_message")
+@mock.patch("game.scheduler.schedule_event")
+class BattleEventRedeliveryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        game_session = GameSession.objects.create(has_started=True, ended_at=timezone.now() + GameSession.DURATION)
+        self.attacker = Player.objects.create(game_session=game_session, nickname="attacker")
+        self.defender = Player.objects.create(game_session=game_session, nickname="defender")
+        Village.objects.filter(id=self.defender.village_id).update(spearman_count=5, wood=500, clay=500, iron=500)
+        now = timezone.now()
+        self.battle = Battle.objects.create(
+            game_session=game_session,
+            attacker=self.attacker,
+            defender=self.defender,
+            attacker_axeman_count=30,
+            start_time=now - timedelta(seconds=10),
+            battle_time=now,
+        )
+
+    def test_events_delivered_twice_are_handled_once(self, schedule_event, send_message):
+        # As the DatabaseScheduler does when it runs an event again after a failure or a crash
+        scheduler.run_event("attack", (self.battle.id,))
+        defender_village = Village.objects.get(id=self.defender.village_id)
+        scheduler.run_event("attack", (self.battle.id,))
+
+        self.assertEqual([call.args[0] for call in schedule_event.call_args_list].count("return_units"), 1)
+        self.assertEqual(Village.objects.get(id=self.defender.village_id).wood, defender_village.wood)
+
+        scheduler.run_event("return_units", (self.battle.id,))
+        attacker_village = Village.objects.get(id=self.attacker.village_id)
+        scheduler.run_event("return_units", (self.battle.id,))
+
+        self.battle.refresh_from_db()
+        self.assertEqual(self.battle.phase, Battle.BattlePhase.FINISHED)
+        self.assertEqual(attacker_village.axeman_count, self.battle.left_attacker_axeman_count)
+        self.assertEqual(Village.objects.get(id=self.attacker.village_id).axeman_count, attacker_village.axeman_count)
+        self.assertEqual(Village.objects.get(id=self.attacker.village_id).wood, attacker_village.wood)
+
+
+class PreviewAttackTestCase(TestCase):
+    def setUp(self):
+        self.game_session = GameSession.objects.create(has_started=True, ended_at=timezone.now() + GameSession.DURATION)
+        self.attacker = Player.objects.create(game_session=self.game_session, nickname="attacker")
+        self.defender = Player.objects.create(game_session=self.game_session, nickname="defender")
+        Village.objects.filter(id=self.attacker.village_id).update(axeman_count=30, spearman_count=5, x=0, y=0)
+        Village.objects.filter(id=self.defender.village_id).update(spearman_count=5, archer_count=2, x=3, y=4)
+        self.attacker = Player.objects.select_related("village", "game_session").get(id=self.attacker.id)
+        self.defender = Player.objects.select_related("village").get(id=self.defender.id)
+        self.units = [{"name": "axeman", "count": 30}, {"name": "spearman", "count": 5}]
+
+    def test_preview_uses_combat_kernel_without_queries(self):
+        with self.assertNumQueries(0):
+            preview = services.VillageService.preview_attack(self.attacker, self.defender, self.units)
+
+        battle_time = datetime.fromisoformat(preview["battleTime"])
+        resources = self.defender.village.project_resources(at=battle_time)
+        outcome = combat.resolve_battle(
+            (5, 0, 30, 0), (5, 0, 0, 2), tuple(resources[name] for name in Village.RESOURCE_NAMES)
+        )
+
+        # The slowest of the sent units sets the travel time over the distance of 5 fields
+        self.assertEqual(preview["travelTime"], (units.Axeman.SPEED * 5).total_seconds())
+        self.assertEqual(preview["result"], Battle.BattleResult.WIN)
+        self.assertEqual(preview["leftAttackerUnits"], dict(zip(Village.UNIT_NAMES, outcome.left_attacker_counts)))
+        self.assertEqual(preview["plunderedResources"], dict(zip(Village.RESOURCE_NAMES, outcome.plundered_resources)))
+        self.assertFalse(Battle.objects.exists())
+
+    def test_preview_counts_units_trained_before_arrival(self):
+        # Trained in 30 seconds, the axemen arrive in 90
+        self.defender.village.enqueue_units([("archer", 3)])
+        defender = Player.objects.select_related("village").get(id=self.defender.id)
+
+        preview = services.VillageService.preview_attack(self.attacker, defender, self.units)
+
+        self.assertEqual(preview["defenderStrength"], (1 + 5 * 15 + 5 * 50) * Village.DEFENSIVE_BONUS)
+        self.assertEqual(defender.village.archer_count, 2)
+
+    def test_view_does_not_preview_players_of_other_game_sessions(self):
+        other_player = Player.objects.create(game_session=GameSession.objects.create(), nickname="other")
+        token = RefreshToken.for_user(self.attacker).access_token
+
+        response = self.client.post(
+            reverse("game:preview_attack", args=(other_player.id,)),
+            data={"units": self.units},
+            content_type="application/json",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_preview_checks_attack_like_attack_player(self):
+        with self.assertRaises(exceptions.InsufficientUnitsException):
+            services.VillageService.preview_attack(self.attacker, self.defender, [{"name": "axeman", "count": 31}])
+
+        with self.assertRaises(exceptions.CannotAttackYourselfException):
+            services.VillageService.preview_attack(self.attacker, self.attacker, self.units)
+
+    def test_view_and_websocket_command_return_preview(self):
+        token = RefreshToken.for_user(self.attacker).access_token
+        response = self.client.post(
+            reverse("game:preview_attack", args=(self.defender.id,)),
+            data={"units": self.units},
+            content_type="application/json",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["result"], Battle.BattleResult.WIN)
+
+        consumer = GameSessionConsumer()
+        consumer.player = self.attacker
+        consumer.has_game_session_started = True
+        consumer.game_session_ended_at = self.game_session.ended_at
+        consumer.send_json = mock.AsyncMock()
+
+        async_to_sync(consumer.receive_json)(
+            {"type": "preview_attack", "defenderId": self.defender.id, "units": self.units}
+        )
+        self.assertEqual(consumer.send_json.call_args.args[0]["data"]["result"], Battle.BattleResult.WIN)
+
+        async_to_sync(consumer.receive_json)({"type": "preview_attack", "defenderId": "2", "units": self.units})
+        self.assertIn("errors", consumer.send_json.call_args.args[0]["data"])
+        self.assertFalse(Battle.objects.exists())
@@ -1,11 +1,25 @@
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.tokens import RefreshToken
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import etag
 
 from game import serializers, services, models
+from utils.jwt_authentication import create_session_token
+
+
+class GameDataView(APIView):
+    permission_classes = []
+    authentication_classes = []
+
+    # The URL is not versioned, so clients revalidate the ETag on every request instead of reusing a stale copy
+    @method_decorator(cache_control(public=True, no_cache=True))
+    @method_decorator(etag(lambda request, *args, **kwargs: services.GameDataService.get_game_data()["version"]))
+    def get(self, request, *args, **kwargs):
+        return Response(services.GameDataService.get_game_data(), status=status.HTTP_200_OK)
 
 
 class CreateJoinGameSessionView(APIView):
@@ -21,9 +35,8 @@ class CreateJoinGameSessionView(APIView):
         game_session = services.GameSessionService.get_or_create_game_session(game_code)
         player = services.GameSessionService.join_game_session(game_session, nickname)
 
-        refresh = RefreshToken.for_user(player)
         response_data = {
-            "token": str(refresh.access_token),
+            "token": create_session_token(player),
             "player_id": player.id,
             "game_session_id": game_session.id,
             "nickname": player.nickname,
@@ -68,6 +81,24 @@ class AttackPlayerView(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class PreviewAttackView(APIView):
+    def post(self, request, defender_id, *args, **kwargs):
+        serializer = serializers.UnitsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # Players of other game sessions are not found, their villages are not to be spied on
+        defender = get_object_or_404(
+            models.Player.objects.select_related("village"),
+            id=defender_id,
+            game_session_id=request.user.game_session_id,
+        )
+        attacker_units = serializer.validated_data["units"]
+
+        preview = services.VillageService.preview_attack(request.user, defender, attacker_units)
+
+        return Response(preview, status=status.HTTP_200_OK)
+
+
 class BattleListView(APIView):
     def get(self, request, *args, **kwargs):
         player = request.user
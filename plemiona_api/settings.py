@@ -53,6 +53,14 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Also holds the battle log of every game session, see game.services.BattleLogService
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://localhost:6379/1",
+    },
+}
+
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -179,3 +187,11 @@ CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
 
 # set the celery timezone
 CELERY_TIMEZONE = "UTC"
+
+# Backend running delayed game events (building upgrades, battles, end of the game), see game/scheduler.py:
+# game.scheduler.CeleryScheduler, game.scheduler.DatabaseScheduler or game.scheduler.AsyncioScheduler
+GAME_SCHEDULER_BACKEND = config("GAME_SCHEDULER_BACKEND", "game.scheduler.CeleryScheduler")
+
+# Number of game-N Celery queues the events of the game sessions are spread over by CeleryScheduler,
+# each queue should be consumed by a single worker process (see README.md)
+GAME_TASK_QUEUES = config("GAME_TASK_QUEUES", 4, cast=int)
@@ -1,11 +1,14 @@
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import Optional
 from urllib.parse import parse_qs
 
 import jwt
 from rest_framework import authentication
 from rest_framework.exceptions import AuthenticationFailed
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from rest_framework_simplejwt.tokens import UntypedToken
+from rest_framework_simplejwt.tokens import RefreshToken
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from channels.auth import AuthMiddlewareStack
@@ -14,6 +17,88 @@ from django.conf import settings
 
 from game.models import Player
 
+# Signed into the websocket token, so the consumer joins its groups without loading the player
+SESSION_CLAIMS = ("player_id", "game_session_id", "game_code", "channel_name")
+
+
+class VerifiedTokenCache:
+    """
+    Keeps the payloads of recently verified tokens, so a token is decoded and its signature checked once per TTL
+    instead of on every request. Holds at most MAX_SIZE tokens, the least recently used are evicted first.
+    """
+
+    MAX_SIZE = 4096
+    TTL = 300  # seconds
+
+    def __init__(self, max_size: int = MAX_SIZE, ttl: float = TTL) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._payloads: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._payloads.get(token)
+            if entry is None:
+                return None
+
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._payloads[token]
+                return None
+
+            self._payloads.move_to_end(token)
+            return payload
+
+    def set(self, token: str, payload: dict) -> None:
+        # Never outlive the token itself
+        expires_at = min(time.time() + self.ttl, payload.get("exp", float("inf")))
+
+        with self._lock:
+            self._payloads[token] = (expires_at, payload)
+            self._payloads.move_to_end(token)
+            while len(self._payloads) > self.max_size:
+                self._payloads.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._payloads.clear()
+
+
+verified_tokens = VerifiedTokenCache()
+
+
+def decode_token(token: str) -> dict:
+    """Returns the payload of a valid token, raises jwt.InvalidTokenError otherwise."""
+    payload = verified_tokens.get(token)
+    if payload is None:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+        verified_tokens.set(token, payload)
+
+    return payload
+
+
+def get_player_with_related(player_id) -> Optional[Player]:
+    # The services use the village and the game session of the player on nearly every action
+    return Player.objects.select_related("village", "game_session").filter(id=player_id).first()
+
+
+def get_session_claims(player: Player) -> dict:
+    return {
+        "player_id": str(player.id),
+        "game_session_id": player.game_session_id,
+        "game_code": player.game_session.game_code,
+        "channel_name": str(player.channel_name),
+    }
+
+
+def create_session_token(player: Player) -> str:
+    token = RefreshToken.for_user(player).access_token
+    for claim, value in get_session_claims(player).items():
+        token[claim] = value
+
+    return str(token)
+
 
 class JWTAuthentication(authentication.BaseAuthentication):
     def authenticate(self, request):
@@ -26,7 +111,7 @@ class JWTAuthentication(authentication.BaseAuthentication):
 
         # Decode the JWT and verify its signature
         try:
-            payload = jwt.decode(jwt_token, settings.SECRET_KEY, algorithms=["HS256"])
+            payload = decode_token(jwt_token)
         except jwt.exceptions.InvalidSignatureError:
             raise AuthenticationFailed("Invalid signature")
         except:
@@ -37,7 +122,7 @@ class JWTAuthentication(authentication.BaseAuthentication):
         if player_id is None:
             raise AuthenticationFailed("Player identifier not found in JWT")
 
-        player = Player.objects.filter(id=player_id).first()
+        player = get_player_with_related(player_id)
         if player is None:
             raise AuthenticationFailed("Player not found")
 
@@ -68,13 +153,10 @@ class JWTAuthentication(authentication.BaseAuthentication):
         token = token.replace("Bearer", "").replace(" ", "")  # clean the token
         return token
 
+
 @database_sync_to_async
 def get_player(validated_token):
-    try:
-        return Player.objects.get(id=validated_token["player_id"])
-
-    except Player.DoesNotExist:
-        return None
+    return get_player_with_related(validated_token.get("player_id"))
 
 
 class JwtAuthMiddleware(BaseMiddleware):
@@ -92,17 +174,18 @@ class JwtAuthMiddleware(BaseMiddleware):
 
         token = token[0]
 
-        # Try to authenticate the user
+        # Try to authenticate the user, the token is verified and decoded at once
         try:
-            # This will automatically validate the token and raise an error if token is invalid
-            UntypedToken(token)
-        except (InvalidToken, TokenError) as e:
+            decoded_data = decode_token(token)
+        except jwt.exceptions.InvalidTokenError:
             # Token is invalid
             return await self.inner(scope, receive, send)
-        else:
-            #  Then token is valid, decode it
-            decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
 
+        if all(claim in decoded_data for claim in SESSION_CLAIMS):
+            # The consumer loads the player itself, together with the state sent on connect.
+            # Not scope["session"], which belongs to the Django session of AuthMiddlewareStack
+            scope["session_claims"] = {claim: decoded_data[claim] for claim in SESSION_CLAIMS}
+        else:
             # Get the user using ID
             scope["player"] = await get_player(validated_token=decoded_data)
         return await super().__call__(scope, receive, send)
@@ -1,3 +1,6 @@
+import copy
+from typing import Iterable
+
 from django.db import models
 
 
@@ -8,3 +11,54 @@ class BaseModel(models.Model):
 
     class Meta:
         abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_stored_values()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._remember_stored_values(kwargs.get("fields"))
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._remember_stored_values(kwargs.get("update_fields"))
+
+    def get_dirty_fields(self) -> list[str]:
+        """Returns the names of the loaded fields whose values differ from the stored ones."""
+        stored_values = getattr(self, "_stored_values", {})
+        return [
+            field.name
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+            and (field.attname not in stored_values or stored_values[field.attname] != self.__dict__[field.attname])
+        ]
+
+    def save_dirty_fields(self, fields: Iterable[str] = ()) -> None:
+        """
+        Saves the changed fields and the given ones only, with a single UPDATE.
+        Instances not saved yet are inserted whole.
+        """
+        if self._state.adding:
+            self.save()
+            return
+
+        update_fields = {*self.get_dirty_fields(), *fields}
+        if update_fields:
+            self.save(update_fields={*update_fields, "updated_at"})
+
+    def _remember_stored_values(self, fields=None):
+        """Keeps a copy of the values stored in the database, after loading or saving the given (or all) fields."""
+        if not hasattr(self, "_stored_values"):
+            self._stored_values = {}
+
+        attnames = {self._meta.get_field(field).attname for field in fields} if fields else None
+        for field in self._meta.concrete_fields:
+            if (attnames is None or field.attname in attnames) and field.attname in self.__dict__:
+                value = self.__dict__[field.attname]
+                # Only JSON values can be changed in place, they are deep copied so that such changes are detected
+                self._stored_values[field.attname] = (
+                    copy.deepcopy(value) if isinstance(field, models.JSONField) else value
+                )
@@ -0,0 +1,49 @@
+from typing import Iterable
+
+from django.db import transaction
+
+from utils.models import BaseModel
+
+
+class UnitOfWork:
+    """
+    Runs a game command in one transaction and saves the registered instances once, when the block exits,
+    each with a single UPDATE of its changed fields (see BaseModel.save_dirty_fields).
+    Nothing is saved if the block raises.
+
+        with UnitOfWork() as unit_of_work:
+            village.morale -= 10
+            unit_of_work.register(village)
+    """
+
+    def __init__(self) -> None:
+        self._instances: dict[int, BaseModel] = {}
+        self._fields: dict[int, set[str]] = {}
+        self._atomic = transaction.atomic()
+
+    def __enter__(self) -> "UnitOfWork":
+        self._atomic.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.flush()
+            except Exception as error:
+                self._atomic.__exit__(type(error), error, error.__traceback__)
+                raise
+
+        return self._atomic.__exit__(exc_type, exc_value, traceback)
+
+    def register(self, *instances: BaseModel, fields: Iterable[str] = ()) -> None:
+        # Instances are saved in the order they were first registered, the given fields even if unchanged
+        for instance in instances:
+            self._instances.setdefault(id(instance), instance)
+            self._fields.setdefault(id(instance), set()).update(fields)
+
+    def flush(self) -> None:
+        for key, instance in self._instances.items():
+            instance.save_dirty_fields(self._fields[key])
+
+        self._instances.clear()
+        self._fields.clear()